@@ -1,21 +1,80 @@
+import hashlib
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 import random
 import re
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, jsonify, make_response, render_template, request, url_for
 from flask_wtf import FlaskForm
 from wtforms import SelectField, TextAreaField
 
-from .generate.generator import PoemMaker
+from .generate import metrics
+from .generate.cache import ResultCache
+from .generate.generator import PoemMaker, new_seed
+from .generate.limits import INVALID, OK
+from .generate.pool import PoemPool
+from .generate.service import PoemService, QueueFull
 
-pm = PoemMaker()
+# count search work and time each stage, for /metrics. off by default, since
+# it adds a little to every poem
+if os.environ.get('POEM_METRICS'):
+    metrics.enable()
+
+# uploaded text's models are cached up to this many bytes in memory, and
+# optionally in a folder shared by every worker on the host. with
+# POEM_MAPPED, every worker serves the sources out of the same mapped files.
+# with POEM_CATALOG_BYTES, sources are loaded when they're first asked for
+# and only about that many bytes of them are kept in memory
+pm = PoemMaker(custom_cache_bytes=int(os.environ.get('POEM_CUSTOM_CACHE_BYTES', 64 * 2**20)),
+               custom_cache_dir=os.environ.get('POEM_CUSTOM_CACHE_DIR') or None,
+               mapped=bool(os.environ.get('POEM_MAPPED')),
+               catalog_bytes=int(os.environ['POEM_CATALOG_BYTES']) if os.environ.get('POEM_CATALOG_BYTES') else None)
 pm.setup()
 
 app = Flask(__name__)
 SECRET_KEY = os.urandom(32)
 app.config['SECRET_KEY'] = SECRET_KEY
+# hard limits on each poem search, to keep request latency bounded. unset
+# means no limit
+app.config['POEM_TIMEOUT'] = float(os.environ['POEM_TIMEOUT']) if os.environ.get('POEM_TIMEOUT') else None
+app.config['POEM_MAX_NODES'] = int(os.environ['POEM_MAX_NODES']) if os.environ.get('POEM_MAX_NODES') else None
+# permalinked poems are kept for the next time they're asked for, up to this
+# many, and browsers are told they can keep them for this many seconds
+app.config['POEM_RESULT_CACHE_SIZE'] = int(os.environ.get('POEM_RESULT_CACHE_SIZE', 1024))
+app.config['POEM_PERMALINK_MAX_AGE'] = int(os.environ.get('POEM_PERMALINK_MAX_AGE', 3600))
+# keep this many poems ready per (source, style) in the background. 0 turns
+# the pool off and every poem is generated during the request
+app.config['POEM_POOL_DEPTH'] = int(os.environ.get('POEM_POOL_DEPTH', 0))
+app.config['POEM_POOL_WORKERS'] = int(os.environ.get('POEM_POOL_WORKERS', 1))
+app.config['POEM_POOL_REFILL_INTERVAL'] = float(os.environ.get('POEM_POOL_REFILL_INTERVAL', 0))
+# check the data folder for new or changed sources this often, in seconds. 0
+# means sources are only read at startup
+app.config['POEM_WATCH_INTERVAL'] = float(os.environ.get('POEM_WATCH_INTERVAL', 0))
+# the JSON API searches on this many threads, and turns requests away with a
+# 429 once this many are running or waiting. requests can ask for shorter
+# timeouts than POEM_API_TIMEOUT and up to POEM_API_MAX_COUNT poems at once
+app.config['POEM_API_WORKERS'] = int(os.environ.get('POEM_API_WORKERS', 4))
+app.config['POEM_API_MAX_PENDING'] = int(os.environ.get('POEM_API_MAX_PENDING', 16))
+app.config['POEM_API_TIMEOUT'] = float(os.environ.get('POEM_API_TIMEOUT', 10))
+app.config['POEM_API_MAX_COUNT'] = int(os.environ.get('POEM_API_MAX_COUNT', 10))
+
+results = ResultCache(app.config['POEM_RESULT_CACHE_SIZE'])
+
+service = PoemService(pm, workers=app.config['POEM_API_WORKERS'], max_pending=app.config['POEM_API_MAX_PENDING'])
+
+if app.config['POEM_WATCH_INTERVAL'] > 0:
+    pm.watch(app.config['POEM_WATCH_INTERVAL'])
+
+pool = None
+if app.config['POEM_POOL_DEPTH'] > 0:
+    pool = PoemPool(pm,
+                    depth=app.config['POEM_POOL_DEPTH'],
+                    workers=app.config['POEM_POOL_WORKERS'],
+                    refill_interval=app.config['POEM_POOL_REFILL_INTERVAL'],
+                    timeout=app.config['POEM_TIMEOUT'],
+                    max_nodes=app.config['POEM_MAX_NODES'])
+    pool.start()
 
 handler = RotatingFileHandler('poems.log', maxBytes=10000, backupCount=1)
 handler.setLevel(logging.INFO)
@@ -33,6 +92,32 @@ class GeneratePoemForm(FlaskForm):
     style = SelectField('Style', choices=[(k, k) for k in pm.poem_styles.keys()])
 
 
+SORRY = "Sorry! I couldn't find a poem in time. Try again?"
+
+
+def seeded_poem(source, style, seed):
+    '''
+    The poem the seed gives for the source and style, from the result cache
+    if it's been made since the sources last changed
+    '''
+    key = (pm.version, source, style, seed)
+    poem = results.get(key)
+    if poem is None:
+        poem = pm.generate(source, style, timeout=app.config['POEM_TIMEOUT'], max_nodes=app.config['POEM_MAX_NODES'],
+                           seed=seed)
+        # one that ran out of time might be found next time, so only keep
+        # the ones that worked
+        if poem.status == OK:
+            results.put(key, poem)
+    return poem
+
+
+def permalink(source, style, poem):
+    if not poem or poem.seed is None:
+        return None
+    return url_for('poem_page', source=source, style=style, seed=poem.seed)
+
+
 class UploadTextForm(FlaskForm):
     poem_format = SelectField('Format', choices=[(k, k) for k in pm.poem_styles.keys()])
     source_text = TextAreaField('Text', render_kw={'rows': 20})
@@ -47,6 +132,8 @@ def generate_page():
                     return k
 
     form = GeneratePoemForm()
+    # sources can come and go while we're running
+    form.source.choices = [(k, k) for k in pm.text_sources.keys()]
 
     app.logger.debug(form.validate())
     if form.errors:
@@ -75,10 +162,53 @@ def generate_page():
         except:
             app.logger.exception('Failed to select source and style')
 
-    poem = pm.generate(source, style)
+    # every poem gets a seed, so it can be linked to and made again
+    if pool is not None:
+        poem = pool.get(source, style)
+        if poem.status == OK:
+            results.put((pm.version, source, style, poem.seed), poem)
+    else:
+        poem = seeded_poem(source, style, new_seed())
+    link = permalink(source, style, poem)
+    if not poem:
+        app.logger.warning('No %s found for %s: %s', style, source, poem.status)
+        poem = SORRY
     app.logger.info(poem)
     print(poem)
-    return render_template('generate.html', form=form, poem=poem)
+    return render_template('generate.html', form=form, poem=poem, permalink=link)
+
+
+@app.route('/poem/<source>/<style>/<seed>')
+def poem_page(source, style, seed):
+    '''
+    The poem a seed gives for a source and style, which is the same every
+    time (until the source changes), so it can be shared. Poems are kept in
+    the result cache, and browsers can keep them too and check back with
+    their ETag
+    '''
+    if source not in pm.text_sources or style not in pm.poem_styles or len(seed) > 64:
+        abort(404)
+
+    form = GeneratePoemForm()
+    form.source.choices = [(k, k) for k in pm.text_sources.keys()]
+    form.source.data = source
+    form.style.data = style
+
+    poem = seeded_poem(source, style, seed)
+    if not poem:
+        app.logger.warning('No %s found for %s with seed %s: %s', style, source, seed, poem.status)
+        response = make_response(render_template('generate.html', form=form, poem=SORRY))
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    response = make_response(render_template('generate.html', form=form, poem=poem,
+                                             permalink=permalink(source, style, poem)))
+    # weak, since the page around the poem (e.g. the form's CSRF token)
+    # changes from one view to the next. private for the same reason
+    response.set_etag(hashlib.sha256(f'{source}\n{style}\n{poem}'.encode()).hexdigest()[:32], weak=True)
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['POEM_PERMALINK_MAX_AGE']
+    return response.make_conditional(request)
 
 
 @app.route('/custom', methods=['GET', 'POST'])
@@ -90,7 +220,8 @@ def upload():
         poem_format = form.poem_format.data
 
         try:
-            poem = pm.generate_custom(source_text, poem_format)
+            poem = pm.generate_custom(source_text, poem_format,
+                                      timeout=app.config['POEM_TIMEOUT'], max_nodes=app.config['POEM_MAX_NODES'])
             if not poem:
                 raise ValueError
             app.logger.info('custom poem!')
@@ -107,5 +238,114 @@ def about():
     return render_template('faq.html')
 
 
+@app.route('/pool')
+def pool_stats():
+    if pool is None:
+        return jsonify(enabled=False)
+    stats = [dict(counts, source=source, style=style) for (source, style), counts in pool.stats().items()]
+    return jsonify(enabled=True, depth=pool.depth, workers=pool.workers, pools=stats)
+
+
+@app.route('/metrics')
+def metrics_page():
+    if not metrics.enabled:
+        abort(404)
+    text = metrics.registry.render()
+    text += metrics.render_gauge('custom_cache', 'Custom model cache stats',
+                                 {(('stat', stat),): value for stat, value in pm.custom_models.stats().items()})
+    text += metrics.render_gauge('source_build_seconds', 'How long each source took to load or build',
+                                 {(('source', source),): seconds for source, seconds in pm.build_times.items()})
+    if pm.catalog_bytes is not None:
+        catalog = pm.text_sources.stats()
+        for stat, help in (('resident_bytes', 'How much memory each catalog source takes up, 0 if not loaded'),
+                           ('first_request_seconds', 'How long the first request for each catalog source waited '
+                                                     'for it to load'),
+                           ('loads', 'How many times each catalog source has been loaded'),
+                           ('evictions', 'How many times each catalog source has been dropped to make room')):
+            text += metrics.render_gauge(f'catalog_source_{stat}', help, {
+                (('source', source),): counts[stat]
+                for source, counts in catalog['sources'].items() if counts[stat] is not None})
+        text += metrics.render_gauge('catalog', 'Source catalog stats',
+                                     {(('stat', stat),): catalog[stat] for stat in ('resident', 'bytes', 'max_bytes')})
+    text += metrics.render_gauge('result_cache', 'Permalinked poem cache stats',
+                                 {(('stat', stat),): value for stat, value in results.stats().items()})
+    if pool is not None:
+        text += metrics.render_gauge('pool', 'Poem pool stats', {
+            (('source', source), ('stat', stat), ('style', style)): value
+            for (source, style), counts in pool.stats().items() for stat, value in counts.items()})
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(pm.custom_models.stats())
+
+
+@app.route('/catalog')
+def catalog_stats():
+    if pm.catalog_bytes is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **pm.text_sources.stats())
+
+
+def api_params():
+    params = request.args.to_dict()
+    params.update(request.get_json(silent=True) or {})
+    count = int(params.get('count', 1))
+    if not 1 <= count <= app.config['POEM_API_MAX_COUNT']:
+        raise ValueError(f'count must be between 1 and {app.config["POEM_API_MAX_COUNT"]}')
+    timeout = min(float(params.get('timeout', app.config['POEM_API_TIMEOUT'])), app.config['POEM_API_TIMEOUT'])
+    seed = params.get('seed')
+    return params, count, None if seed is None else str(seed), timeout
+
+
+def api_response(poems, seed, fields):
+    body = dict(fields, seed=seed, poems=[{'text': str(poem), 'lines': poem.split('\n') if poem else [],
+                                           'status': poem.status, 'nodes': poem.nodes, 'retries': poem.retries}
+                                          for poem in poems])
+    if any(poem.status == INVALID for poem in poems):
+        body['error'] = str(poems[0])
+        return jsonify(body), 400
+    return jsonify(body)
+
+
+def api_call(generate, fields):
+    try:
+        params, count, seed, timeout = api_params()
+        poems = generate(params, count=count, seed=seed, timeout=timeout, max_nodes=app.config['POEM_MAX_NODES'])
+    except QueueFull:
+        return jsonify(error='Too many poems being written right now. Try again in a bit'), 429, {'Retry-After': '1'}
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify(error=f'Bad request: {e}'), 400
+    return api_response(poems, seed, {field: params[field] for field in fields})
+
+
+@app.route('/api/generate', methods=['GET', 'POST'])
+def api_generate():
+    '''
+    JSON poems from one of the sources. Takes source, style, count, seed and
+    timeout (seconds) from the query string or a JSON body
+    '''
+    def generate(params, **kwargs):
+        return service.generate(params['source'], params['style'], **kwargs)
+    return api_call(generate, ('source', 'style'))
+
+
+@app.route('/api/custom', methods=['POST'])
+def api_custom():
+    '''
+    JSON poems from the text given in the request, with style, count, seed and
+    timeout like /api/generate
+    '''
+    def generate(params, **kwargs):
+        if not isinstance(params['text'], str):
+            raise TypeError('text must be a string')
+        try:
+            return service.generate_custom(params['text'], params['style'], **kwargs)
+        except IndexError:
+            raise ValueError("couldn't find a poem in that text")
+    return api_call(generate, ('style',))
+
+
 if __name__ == '__main__':
     app.run()
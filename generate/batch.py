@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+import time
+
+from .generator import DATA_FOLDER, PoemMaker
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a batch of poems as JSON lines')
+    parser.add_argument('source')
+    parser.add_argument('style')
+    parser.add_argument('n', type=int)
+    parser.add_argument('-o', '--output', help='file to write to (default: stdout)')
+    parser.add_argument('-w', '--workers', type=int, help='generate in this many processes')
+    parser.add_argument('--data-folder', default=DATA_FOLDER)
+    parser.add_argument('--timeout', type=float, help='seconds allowed per poem')
+    parser.add_argument('--max-nodes', type=int, help='search nodes allowed per poem')
+    args = parser.parse_args()
+
+    pm = PoemMaker(args.data_folder)
+    pm.setup()
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    start = time.perf_counter()
+    count = 0
+    try:
+        for poem in pm.generate_many(args.source, args.style, args.n, workers=args.workers,
+                                     timeout=args.timeout, max_nodes=args.max_nodes):
+            out.write(json.dumps({'source': args.source, 'style': args.style, 'poem': poem,
+                                  'status': poem.status, 'nodes': poem.nodes}) + '\n')
+            out.flush()
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f'{count} poems in {elapsed:.2f}s ({count / elapsed:.1f}/s)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+import argparse
+from functools import partial
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from . import __version__
+from .generator import DATA_FOLDER, PoemMaker
+from .ingest import source_files
+from .limits import OK
+from .poems import build_models, tokenize
+from .scansion import drop_end, encode, fits_end
+from .syllables import scansion_matches
+
+# used for synthetic corpora when there's no bundled data to borrow words from
+FALLBACK_WORDS = ('the love of my heart is a rose in the night and a song that we sing to the moon as it falls '
+                  'over water and stone while the day turns away from the light of a star in the sky').split()
+
+# a change in p50 or p95 worse than this counts as a regression
+DEFAULT_THRESHOLD = 0.1
+
+
+def percentile(values, p):
+    '''
+    The nearest rank percentile of values, or None if there aren't any
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(name, seconds, statuses=None, nodes=None, peak_bytes=None, **extra):
+    result = {
+        'name': name,
+        'runs': len(seconds),
+        'mean': sum(seconds) / len(seconds) if seconds else None,
+        'p50': percentile(seconds, 50),
+        'p95': percentile(seconds, 95),
+        'p99': percentile(seconds, 99),
+        'peak_bytes': peak_bytes,
+    }
+    if statuses is not None:
+        result['failure_rate'] = sum(1 for status in statuses if status != OK) / len(statuses) if statuses else None
+        result['statuses'] = {status: statuses.count(status) for status in sorted(set(statuses))}
+    if nodes is not None:
+        result['nodes_mean'] = sum(nodes) / len(nodes) if nodes else None
+        result['nodes_p50'] = percentile(nodes, 50)
+        result['nodes_p95'] = percentile(nodes, 95)
+    result.update(extra)
+    return result
+
+
+def traced_peak(fn):
+    '''
+    Run fn once with tracemalloc on and return the most memory it had
+    allocated at any point, in bytes. Tracing slows everything down, so this
+    is kept apart from the timed runs
+    '''
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def corpus_words(data_folder):
+    words = []
+    if os.path.isdir(data_folder):
+        for filename in sorted(os.listdir(data_folder)):
+            if filename.startswith('.'):
+                continue
+            for filepath in source_files(os.path.join(data_folder, filename)):
+                with open(filepath, errors='replace') as f:
+                    words.extend(tokenize(f.read()))
+    return words or list(FALLBACK_WORDS)
+
+
+def synthetic_corpus(words, size, seed):
+    '''
+    size words of made up text as a list of chunks, drawn from words with
+    their own frequencies, in lines of 5 to 10 words and chunks of 4 to 12
+    lines. The same seed always makes the same corpus
+    '''
+    rng = random.Random(seed)
+    chunks = []
+    total = 0
+    while total < size:
+        lines = []
+        for _ in range(rng.randint(4, 12)):
+            n = min(rng.randint(5, 10), size - total)
+            if n <= 0:
+                break
+            lines.append(' '.join(rng.choice(words) for _ in range(n)))
+            total += n
+        chunks.append('\n'.join(lines))
+    return chunks
+
+
+def bench_build(name, chunks, runs):
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        models = build_models(chunks)
+        seconds.append(time.perf_counter() - start)
+    peak = traced_peak(lambda: build_models(chunks))
+    return summarize(name, seconds, peak_bytes=peak, words=sum(len(chunk.split()) for chunk in chunks),
+                     vocabulary=len(models.lexicon))
+
+
+def bench_poems(name, make_poem, runs, seed):
+    '''
+    Time runs poems from make_poem(seed), each with its own seed derived from
+    seed, so every run of the benchmark asks for exactly the same poems
+    '''
+    seconds, statuses, nodes = [], [], []
+    for i in range(runs):
+        start = time.perf_counter()
+        poem = make_poem(f'{seed}:{i}')
+        seconds.append(time.perf_counter() - start)
+        statuses.append(poem.status)
+        nodes.append(poem.nodes)
+    peak = traced_peak(lambda: make_poem(f'{seed}:peak'))
+    return summarize(name, seconds, statuses, nodes, peak)
+
+
+def _string_checks(pairs):
+    for fp, meter in pairs:
+        if len(fp) <= len(meter) and scansion_matches(fp, meter[-len(fp):]):
+            meter[:-len(fp)]
+
+
+def _packed_checks(pairs):
+    for fp, meter in pairs:
+        if fits_end(fp, meter):
+            drop_end(fp, meter)
+
+
+def bench_scansion(lexicon, meters, runs):
+    '''
+    How fast the backtracker's inner check (does a word fit at the end of
+    the meter, and what's left if so) runs on meter strings and on packed
+    meters, for every word against every meter the styles can leave
+    '''
+    remaining = {meter[:i] for meter in meters for i in range(1, len(meter) + 1)}
+    string_pairs = [(entry[0], meter) for entry in lexicon.entries.values() for meter in remaining]
+    packed_pairs = [(encode(fp), encode(meter)) for fp, meter in string_pairs]
+
+    results = []
+    for name, check, pairs in (('scansion/string', _string_checks, string_pairs),
+                               ('scansion/packed', _packed_checks, packed_pairs)):
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            check(pairs)
+            seconds.append(time.perf_counter() - start)
+        best = min(seconds)
+        results.append(summarize(name, seconds, checks=len(pairs),
+                                 checks_per_second=len(pairs) / best if best else None))
+    return results
+
+
+def run_benchmarks(data_folder=DATA_FOLDER, sizes=(10000, 100000), runs=20, build_runs=3, seed=0,
+                   timeout=None, max_nodes=None, custom_size=5000, only=None, report=None):
+    '''
+    Run every benchmark and return the results as a JSON-able dict. only
+    picks some of 'build', 'scansion', 'styles' and 'custom'; report is called with each
+    result as it's done
+    '''
+    only = set(only or ('build', 'scansion', 'styles', 'custom'))
+    random.seed(seed)
+    results = []
+
+    def add(result):
+        results.append(result)
+        if report is not None:
+            report(result)
+
+    words = corpus_words(data_folder)
+
+    if 'build' in only:
+        for size in sizes:
+            add(bench_build(f'build/synthetic-{size}', synthetic_corpus(words, size, seed), build_runs))
+        if os.path.isdir(data_folder):
+            for filename in sorted(os.listdir(data_folder)):
+                if filename.startswith('.'):
+                    continue
+                chunks = []
+                for filepath in source_files(os.path.join(data_folder, filename)):
+                    with open(filepath, errors='replace') as f:
+                        chunks.extend(f.read().split('\n\n'))
+                add(bench_build(f'build/{filename}', chunks, build_runs))
+
+    if 'scansion' in only:
+        # the meters of the built in styles
+        meters = ('01' * 5, '10101010', '1010101', '01001001', '01001', '01' * 4, '01' * 3)
+        lexicon = build_models([' '.join(sorted(set(words)))]).lexicon
+        for result in bench_scansion(lexicon, meters, build_runs):
+            add(result)
+
+    if only & {'styles', 'custom'}:
+        # snapshots off so every run starts from the same freshly built models
+        pm = PoemMaker(data_folder, snapshots=False)
+        pm.setup()
+
+        if 'styles' in only:
+            for source in sorted(pm.text_sources):
+                for style in pm.poem_styles:
+                    make_poem = partial(pm.generate, source, style, timeout, max_nodes)
+                    add(bench_poems(f'style/{source}/{style}', lambda s: make_poem(seed=s), runs, seed))
+
+        if 'custom' in only:
+            text = '\n\n'.join(synthetic_corpus(words, custom_size, seed))
+
+            def make_custom(style, s):
+                # an upload nobody's made before, so the model gets built too
+                pm.custom_models.clear()
+                return pm.generate_custom(text, style, timeout, max_nodes, seed=s)
+
+            for style in pm.poem_styles:
+                add(bench_poems(f'custom/{style}', partial(make_custom, style), runs, seed))
+
+    return {
+        'meta': {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': seed,
+            'runs': runs,
+            'build_runs': build_runs,
+            'timeout': timeout,
+            'max_nodes': max_nodes,
+        },
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD):
+    '''
+    Line up two sets of results by name and return [(name, stat, old value,
+    new value, relative change, regressed)] for p50 and p95 latency and
+    failure rate
+    '''
+    old_results = {result['name']: result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        before = old_results.get(result['name'])
+        if before is None:
+            continue
+        for stat in ('p50', 'p95', 'failure_rate'):
+            a, b = before.get(stat), result.get(stat)
+            if a is None or b is None:
+                continue
+            if stat == 'failure_rate':
+                change = b - a
+            else:
+                change = (b - a) / a if a else 0.0
+            rows.append((result['name'], stat, a, b, change, change > threshold))
+    return rows
+
+
+def format_result(result):
+    line = (f'{result["name"]:<40} p50 {result["p50"] * 1000:9.2f}ms  p95 {result["p95"] * 1000:9.2f}ms  '
+            f'p99 {result["p99"] * 1000:9.2f}ms')
+    if result['peak_bytes'] is not None:
+        line += f'  peak {result["peak_bytes"] / 2**20:7.1f} MiB'
+    if result.get('checks_per_second'):
+        line += f'  {result["checks_per_second"] / 1e6:6.2f}M checks/s'
+    if 'failure_rate' in result:
+        line += f'  failed {result["failure_rate"]:6.1%}  nodes p50 {result["nodes_p50"]}'
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark model building and poem generation')
+    parser.add_argument('--data-folder', default=DATA_FOLDER)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='synthetic corpus sizes to build, in words')
+    parser.add_argument('--runs', type=int, default=20, help='poems per style')
+    parser.add_argument('--build-runs', type=int, default=3, help='builds per corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, help='seconds allowed per poem')
+    parser.add_argument('--max-nodes', type=int, help='search nodes allowed per poem')
+    parser.add_argument('--custom-size', type=int, default=5000, help='words of uploaded text for generate_custom')
+    parser.add_argument('--only', nargs='+', choices=['build', 'scansion', 'styles', 'custom'])
+    parser.add_argument('-o', '--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results from an earlier run to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='how much worse p50 or p95 can get before it counts as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.data_folder, args.sizes, args.runs, args.build_runs, args.seed,
+                             args.timeout, args.max_nodes, args.custom_size, args.only,
+                             report=lambda result: print(format_result(result), file=sys.stderr))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressed = False
+        for name, stat, a, b, change, worse in compare(old, results, args.threshold):
+            regressed |= worse
+            print(f'{name:<40} {stat:<12} {a:10.4f} -> {b:10.4f} ({change:+.1%}){"  REGRESSED" if worse else ""}')
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
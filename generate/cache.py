@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+
+from . import __version__
+from .markov import sizeof
+from .poems import build_models
+from .snapshot import SNAPSHOT_FORMAT, load_models, write_models
+
+DEFAULT_MAX_BYTES = 64 * 2**20
+DEFAULT_MAX_RESULTS = 1024
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def models_size(models):
+    '''
+    Roughly how many bytes a set of models takes up. Their search indexes
+    start out empty, and cached models are never searched on directly (see
+    PoemMaker.generate_custom), so that's all they ever take up
+    '''
+    return sizeof((models.d, models.rev_d, models.seeds, models.lexicon.entries, models.lexicon.rhymes))
+
+
+class ModelCache:
+    '''
+    Models built from uploaded text, kept by the sha256 of the text so the
+    cache never holds onto the text itself
+
+    max_bytes caps how much memory the cached models take up, going by
+    models_size; the least recently used are dropped to make room. Models
+    bigger than that on their own are never kept in memory.
+
+    With directory set, models are also saved there in the snapshot format,
+    so every worker process on a host can load what any of them built
+    instead of building it again. max_disk_bytes caps how much that takes up,
+    dropping the least recently used files first.
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError:
+                # the cache is only there to save time, so carry on without
+                # the disk tier until the folder can be used
+                logging.warning('Could not create custom model cache folder %s', directory, exc_info=True)
+
+        # {text key: (models, size)}, least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.counts = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.models')
+
+    def _disk_key(self, key):
+        return f'{SNAPSHOT_FORMAT}:{__version__}:{key}'
+
+    def get(self, text):
+        '''
+        The cached models for the text, or None
+        '''
+        key = text_key(text)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counts['hits'] += 1
+                return entry[0]
+
+        if self.directory is not None:
+            path = self._path(key)
+            models = load_models(path, self._disk_key(key))
+            if models is not None:
+                try:
+                    # keep the disk tier in least recently used order too
+                    os.utime(path)
+                except OSError:
+                    pass
+                with self._lock:
+                    self.counts['disk_hits'] += 1
+                self._remember(key, models)
+                return models
+
+        with self._lock:
+            self.counts['misses'] += 1
+        return None
+
+    def put(self, text, models):
+        key = text_key(text)
+        self._remember(key, models)
+        if self.directory is not None:
+            try:
+                write_models(models, self._path(key), self._disk_key(key))
+                if self.max_disk_bytes is not None:
+                    self._prune_disk()
+            except OSError:
+                # a full or read-only cache folder shouldn't stop us from
+                # serving poems
+                logging.warning('Could not save custom models to %s', self.directory, exc_info=True)
+
+    def get_or_build(self, text):
+        models = self.get(text)
+        if models is None:
+            models = build_models([text])
+            self.put(text, models)
+        return models
+
+    def _remember(self, key, models):
+        size = models_size(models)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (models, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.counts['evictions'] += 1
+
+    def _prune_disk(self):
+        files = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.models'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                # another process got to it first
+                pass
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        '''
+        Hit, disk hit, miss, and eviction counts, and how full the cache is
+        '''
+        with self._lock:
+            return dict(self.counts, entries=len(self.entries), bytes=self.bytes, max_bytes=self.max_bytes)
+
+
+class ResultCache:
+    '''
+    Finished poems by what they were asked for with, e.g. (source, style,
+    seed), so a seeded poem that's asked for again doesn't need searching
+    for. Keeps the max_entries most recently used
+    '''
+    def __init__(self, max_entries=DEFAULT_MAX_RESULTS):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            poem = self.entries.get(key)
+            if poem is None:
+                self.counts['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            return poem
+
+    def put(self, key, poem):
+        with self._lock:
+            self.entries[key] = poem
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, entries=len(self.entries), max_entries=self.max_entries)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from collections.abc import Mapping
+import threading
+import time
+
+from . import metrics
+from .cache import DEFAULT_MAX_BYTES, models_size
+
+
+class SourceCatalog(Mapping):
+    '''
+    {source: Models} for more sources than fit in memory at once. Sources
+    are only known by path until they're first asked for, when load(name,
+    path) loads or builds their models
+
+    max_bytes caps how much memory the loaded models take up, going by
+    models_size when they're loaded; the least recently used are dropped to
+    make room and loaded again from their snapshots (or mapped files) next
+    time they're asked for. The source asked for last always stays, even if
+    it's bigger than that on its own.
+
+    Checking whether a source is in the catalog or listing them never loads
+    anything.
+    '''
+    def __init__(self, load, paths=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.load = load
+        self.max_bytes = max_bytes
+        # {source: path}, in the order they were found
+        self.paths = dict(paths or {})
+        # {source: (models, size)}, least recently used first
+        self.resident = OrderedDict()
+        self.bytes = 0
+        self.counts = {name: self._new_counts() for name in self.paths}
+        self._lock = threading.Lock()
+        # one lock per source, so a source asked for by several requests at
+        # once is only loaded once
+        self._loading = {}
+
+    @staticmethod
+    def _new_counts():
+        return {'hits': 0, 'loads': 0, 'evictions': 0, 'first_request_seconds': None, 'load_seconds': None}
+
+    def __contains__(self, name):
+        return name in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _resident(self, name):
+        with self._lock:
+            entry = self.resident.get(name)
+            if entry is not None:
+                self.resident.move_to_end(name)
+                self.counts[name]['hits'] += 1
+                return entry[0]
+        return None
+
+    def __getitem__(self, name):
+        if name not in self.paths:
+            raise KeyError(name)
+        models = self._resident(name)
+        if models is not None:
+            return models
+
+        with self._lock:
+            loading = self._loading.setdefault(name, threading.Lock())
+        with loading:
+            # someone else might have loaded it while we waited
+            models = self._resident(name)
+            if models is not None:
+                return models
+
+            path = self.paths.get(name)
+            if path is None:
+                raise KeyError(name)
+            start = time.perf_counter()
+            models = self.load(name, path)
+            seconds = time.perf_counter() - start
+            metrics.observe('source_load_seconds', seconds, source=name)
+
+            with self._lock:
+                counts = self.counts.setdefault(name, self._new_counts())
+                counts['loads'] += 1
+                counts['load_seconds'] = seconds
+                if counts['first_request_seconds'] is None:
+                    counts['first_request_seconds'] = seconds
+                if self.paths.get(name) == path:
+                    self._remember(name, models, models_size(models))
+        return models
+
+    def _remember(self, name, models, size):
+        # with the lock held
+        old = self.resident.pop(name, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.resident[name] = (models, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.resident) > 1:
+            evicted, (_, evicted_size) = self.resident.popitem(last=False)
+            self.bytes -= evicted_size
+            self.counts[evicted]['evictions'] += 1
+            metrics.inc('source_evictions_total', source=evicted)
+
+    def is_loaded(self, name):
+        with self._lock:
+            return name in self.resident
+
+    def add(self, name, path):
+        '''
+        Start serving the source at path as name, replacing any source
+        already called that. It's loaded the next time it's asked for
+        '''
+        with self._lock:
+            self.paths[name] = path
+            self.counts.setdefault(name, self._new_counts())
+            old = self.resident.pop(name, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def remove(self, name):
+        with self._lock:
+            self.paths.pop(name, None)
+            self.counts.pop(name, None)
+            old = self.resident.pop(name, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def update(self, name, change):
+        '''
+        Replace a loaded source's models with change(models). Returns False,
+        without calling change, if the source isn't loaded
+
+        change runs without the catalog locked, so lookups of every source
+        carry on while it does. If the source is dropped or loaded again
+        in the meantime, change is run again on whatever's there now
+        '''
+        while True:
+            with self._lock:
+                entry = self.resident.get(name)
+            if entry is None:
+                return False
+            models = change(entry[0])
+            with self._lock:
+                if self.resident.get(name) is entry:
+                    self.resident[name] = (models, entry[1])
+                    return True
+
+    def stats(self):
+        '''
+        {source: hit, load and eviction counts, how long the first request
+        and the last load took, and how many bytes it takes up if it's
+        loaded}, and how full the catalog is
+        '''
+        with self._lock:
+            sources = {}
+            for name, counts in self.counts.items():
+                entry = self.resident.get(name)
+                sources[name] = dict(counts, resident=entry is not None,
+                                     resident_bytes=entry[1] if entry is not None else 0)
+            return {'sources': sources, 'resident': len(self.resident), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes}
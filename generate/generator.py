@@ -1,31 +1,139 @@
-from functools import lru_cache
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import partial
+import logging
 import os
+import random
+import threading
+import time
+import weakref
 
-from .poems import (build_models, get_file, generate_haiku, generate_limerick,
+from . import metrics
+from .cache import DEFAULT_MAX_BYTES, ModelCache
+from .catalog import SourceCatalog
+from .index import SuccessorIndex
+from .ingest import build_source, build_sources, source_name
+from .poems import (compile_form, generate_haiku, generate_limerick,
                             generate_raven_verse, generate_sonnet, generate_common_meter)
+from .limits import EXHAUSTED, INVALID, OK, PoemResult, SearchBudget, SearchLimitReached
+from .mapped import lock_mapped, lock_path, mapped_path, open_mapped, write_mapped
+from .markov import compact_models
+from .parallel import ParallelRhymeSearch, generate_batch
+from .snapshot import load_or_build, load_snapshot, save_snapshot, snapshot_key, snapshot_path
+from .update import DataFolderWatcher, extend_models
 
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
+# how many forms made up on the fly get to keep what their searches learned
+# about each source. the rest start from scratch
+FORM_INDEXES = 32
+
+
+def remove_cached(path):
+    '''
+    Delete the snapshot and mapped files saved for the source at path, if
+    there are any
+    '''
+    for cached in (snapshot_path(path), mapped_path(path), lock_path(path)):
+        try:
+            os.remove(cached)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.warning('Could not remove %s', cached, exc_info=True)
+
+
+def record_search(result, budget, seconds):
+    metrics.inc('poems_total', status=result.status)
+    metrics.observe('poem_seconds', seconds)
+    metrics.inc('search_nodes_total', budget.nodes)
+    metrics.inc('search_dead_ends_total', budget.dead_ends)
+    metrics.inc('search_memo_hits_total', budget.memo_hits)
+    metrics.inc('rhyme_retries_total', budget.retries)
+
+
+def make_rng(seed=None):
+    '''
+    A random generator of its own for a seeded request, or the random module
+    '''
+    return random.Random(seed) if seed is not None else random
+
+
+def new_seed():
+    '''
+    A fresh seed for a poem that should be reproducible later, e.g. to link
+    to it
+    '''
+    return f'{random.getrandbits(32):08x}'
+
 
 class PoemMaker:
-    def __init__(self, data_folder=DATA_FOLDER):
+    def __init__(self, data_folder=DATA_FOLDER, snapshots=True, compact=False, workers=None, race=2,
+                 build_workers=None, shard_size=None, custom_cache_bytes=DEFAULT_MAX_BYTES, custom_cache_dir=None,
+                 mapped=False, catalog_bytes=None):
         self.data_folder = data_folder
+        self.snapshots = snapshots
+        self.compact = compact
+        self.mapped = mapped
+        self.catalog_bytes = catalog_bytes
+        self.workers = workers
+        self.race = race
+        self.build_workers = build_workers
+        self.shard_size = shard_size
+        self.parallel = None
         self.text_sources = {}
+        self.build_times = {}
         self.poem_styles = {}
+        self.custom_models = ModelCache(custom_cache_bytes, custom_cache_dir)
+        self.watcher = None
+        # goes up every time a source is added, removed or changed, so
+        # anything remembering poems can tell they might come out differently
+        self.version = 0
         self.set_up = False
+        # only one update to the sources at a time
+        self._update_lock = threading.Lock()
+        # {source's rev_index: {form's meters: scratch index}}, least recently
+        # used first. see _form_index
+        self._form_indexes = weakref.WeakKeyDictionary()
+        self._form_lock = threading.Lock()
 
-    def setup(self):
+    def setup(self, progress=None):
         '''
         Run once before generating any poems to build Markov and rhyme models
-        for every data source found in the given data folder
-        '''
-        texts = os.listdir(DATA_FOLDER)
+        for every data source found in the given data folder. A source is
+        either a text file or a directory of them
 
-        for filename in texts:
+        With snapshots on, models are loaded from the snapshot saved next to
+        each source when it's still valid, and rebuilt and saved otherwise.
+        With build_workers set, sources are built in a pool of that many
+        processes, split into shards of shard_size bytes; progress is called
+        with (source, shards done, total shards) along the way. How long each
+        source took to load or build ends up in build_times.
+        With compact on, the Markov dictionaries are packed into integer
+        arrays to save memory. With mapped on, each source is served straight
+        out of a read-only file next to it (see mapped.py) that every process
+        maps, so they all share one copy instead of building or loading their
+        own; it's written the first time and whenever the source changes, by
+        whichever process gets there first while the rest wait for it.
+        With catalog_bytes set, sources are only found here, and each one is
+        loaded or built the first time it's asked for; text_sources is then
+        a SourceCatalog keeping at most about that many bytes of them in
+        memory, which reports how each source is doing in stats().
+        With workers set, a pool of that many processes is started to search
+        the rhymes of each poem in parallel
+        '''
+        sources = {}
+        for filename in os.listdir(self.data_folder):
             if filename.startswith('.'):
                 continue
             # strip '.txt' from filename for the string key
-            self.text_sources[filename[:-4]] = build_models(get_file(os.path.join(DATA_FOLDER, filename)))
+            sources[source_name(filename)] = os.path.join(self.data_folder, filename)
+
+        if self.catalog_bytes is not None:
+            self.text_sources = SourceCatalog(self._load_source, sources, self.catalog_bytes)
+        else:
+            with ExitStack() as held:
+                self._setup_sources(sources, held, progress)
 
         self.poem_styles['haiku'] = generate_haiku
         self.poem_styles['limerick'] = generate_limerick
@@ -33,25 +141,359 @@ class PoemMaker:
         self.poem_styles['sonnet'] = generate_sonnet
         self.poem_styles['common meter'] = generate_common_meter
 
+        if self.workers:
+            self.parallel = ParallelRhymeSearch(self.text_sources, self.workers, self.race)
+
         self.set_up = True
 
-    def generate(self, source, style):
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+
+    def watch(self, interval=5.0):
+        '''
+        Start checking the data folder every interval seconds in the
+        background, and pick up sources as they're added, removed, or changed
+        '''
+        self.watcher = DataFolderWatcher(self, interval)
+        self.watcher.start()
+
+    def _setup_sources(self, sources, held, progress):
+        # load or build every source for setup(). with mapped on, the locks on
+        # the mapped files this process is going to write are kept in held
+        loaded = {}
+        to_build = {}
+        keys = {}
+        if self.snapshots or self.mapped:
+            keys = {name: snapshot_key(filepath) for name, filepath in sources.items()}
+
+        if self.mapped:
+            # whoever holds a source's lock is writing its mapped file, so
+            # wait for them and map what they wrote. the locks are taken in
+            # the same order everywhere, so no two processes ever wait on
+            # each other
+            for name in sorted(sources):
+                start = time.perf_counter()
+                path = mapped_path(sources[name])
+                models = open_mapped(path, keys[name])
+                if models is None:
+                    held.enter_context(lock_mapped(sources[name]))
+                    models = open_mapped(path, keys[name])
+                if models is not None:
+                    loaded[name] = (models, time.perf_counter() - start)
+        opened = set(loaded)
+
+        for name, filepath in sources.items():
+            if name in opened:
+                continue
+            start = time.perf_counter()
+            models = load_snapshot(filepath, keys[name]) if self.snapshots else None
+            if models is None:
+                to_build[name] = filepath
+            else:
+                loaded[name] = (models, time.perf_counter() - start)
+
+        loaded.update(build_sources(to_build, self.build_workers, self.shard_size, progress))
+
+        for name, filepath in sources.items():
+            models, seconds = loaded[name]
+            if self.snapshots and name in to_build:
+                try:
+                    save_snapshot(models, filepath, keys[name])
+                except OSError:
+                    # a read-only data folder shouldn't stop us from serving poems
+                    logging.warning('Could not save snapshot for %s', filepath, exc_info=True)
+            if self.mapped and name not in opened:
+                models = self._map(models, filepath, keys[name])
+            elif self.compact and name not in opened:
+                models = compact_models(models)
+            self.text_sources[name] = models
+            self.build_times[name] = seconds
+
+    def add_source(self, name, path):
+        '''
+        Load or build the source at path and start serving it as name,
+        replacing any source already called that
+        '''
+        if self.catalog_bytes is not None:
+            # it's loaded again from the new path next time it's asked for
+            with self._update_lock:
+                self.text_sources.add(name, path)
+                self._set_sources(self.text_sources)
+            return
+        models = self._load_source(name, path)
+        with self._update_lock:
+            self._set_sources({**self.text_sources, name: models})
+
+    def _load_source(self, name, path):
+        # load or build one source's models, in whatever form they're served
+        start = time.perf_counter()
+        if self.mapped:
+            models = self._load_mapped(path)
+        else:
+            models = load_or_build(path) if self.snapshots else build_source(path)
+            if self.compact:
+                models = compact_models(models)
+        self.build_times[name] = time.perf_counter() - start
+        return models
+
+    def _load_mapped(self, path):
+        # map the source's mapped file, first building and writing it if it
+        # isn't there. if another process is doing that already, wait for it
+        # and map what it wrote
+        key = snapshot_key(path)
+        models = open_mapped(mapped_path(path), key)
+        if models is not None:
+            return models
+        with lock_mapped(path):
+            models = open_mapped(mapped_path(path), key)
+            if models is None:
+                models = self._map(load_or_build(path) if self.snapshots else build_source(path), path, key)
+        return models
+
+    def _map(self, models, filepath, key):
+        # write the source's mapped file and serve from that, so this process
+        # doesn't keep its own copy of the models either
+        path = mapped_path(filepath)
+        try:
+            write_mapped(models, path, key)
+        except OSError:
+            logging.warning('Could not save mapped models for %s', filepath, exc_info=True)
+            return compact_models(models) if self.compact else models
+        return open_mapped(path, key) or models
+
+    def remove_source(self, name, path=None):
+        '''
+        Stop serving a source. With path, where the source was read from (in
+        catalog mode, the catalog knows), the snapshot and mapped files saved
+        next to it are deleted too
+        '''
+        with self._update_lock:
+            if self.catalog_bytes is not None:
+                if path is None:
+                    path = self.text_sources.paths.get(name)
+                self.text_sources.remove(name)
+                self._set_sources(self.text_sources)
+            else:
+                text_sources = dict(self.text_sources)
+                if text_sources.pop(name, None) is not None:
+                    self._set_sources(text_sources)
+            self.build_times.pop(name, None)
+        if path is not None:
+            remove_cached(path)
+
+    def append_text(self, source, text, if_loaded=False):
+        '''
+        Add more text to a source without rebuilding it. It takes about as
+        long as it takes to build models from the new text alone. The added
+        text only lives in memory, so it's gone after a restart unless it's
+        also in the source's file (and in catalog mode, once the source is
+        dropped to make room for others)
+
+        With if_loaded on, a catalog source that isn't loaded is left alone,
+        e.g. when the text was added to its file and so will be read from
+        there whenever it's loaded
+        '''
+        with self._update_lock:
+            if self.catalog_bytes is not None:
+                catalog = self.text_sources
+                extend = partial(extend_models, text=text)
+                if not catalog.update(source, extend):
+                    if if_loaded:
+                        return
+                    catalog[source]
+                    catalog.update(source, extend)
+                self._set_sources(catalog)
+                return
+            models = extend_models(self.text_sources[source], text)
+            self._set_sources({**self.text_sources, source: models})
+
+    def _set_sources(self, text_sources):
+        # never change the sources in place: a request grabs the models it
+        # needs once, so ones already under way finish with what they started
+        # with and never see half an update
+        if self.parallel is not None:
+            # the workers have their own copies of the models, so they need
+            # replacing too. the old ones finish what they're doing first
+            old = self.parallel
+            self.parallel = ParallelRhymeSearch(text_sources, self.workers, self.race)
+            old.close(cancel=False)
+        self.text_sources = text_sources
+        self.version += 1
+
+    def _rhyme_search(self, source, models):
+        # the parallel workers might be a step behind or ahead of models while
+        # the sources are being updated, in which case search right here
+        parallel = self.parallel
+        if parallel is None or parallel.text_sources.get(source) is not models:
+            return None
+        return partial(parallel.search, source)
+
+    def is_loaded(self, source):
+        '''
+        True if the source's models are in memory, which outside of catalog
+        mode they all are
+        '''
+        if self.catalog_bytes is not None:
+            return self.text_sources.is_loaded(source)
+        return source in self.text_sources
+
+    def generate(self, source, style, timeout=None, max_nodes=None, seed=None, cancel=None):
+        '''
+        Generate a poem and return it as a PoemResult
+
+        timeout (in seconds) and max_nodes put a hard limit on the search. If
+        either is hit, the result is empty and its status says which one.
+        Setting cancel (a threading.Event) stops the search early the same
+        way. seed seeds the random choices; seeded poems are searched in this
+        process rather than by the parallel workers, whose races would make
+        them come out differently. style is a style's name or a form (see
+        find_style)
+        '''
+        text_sources = self.text_sources
+        invalid = self.check_request(source, style, text_sources)
+        if invalid is not None:
+            return invalid
+
+        # start the clock before a catalog source is loaded, so the timeout
+        # covers that too
+        budget = SearchBudget(timeout, max_nodes, cancel)
+        models = text_sources[source]
+        rhyme_search = self._rhyme_search(source, models) if seed is None else None
+        result = self.run_style(models, style, budget, rhyme_search, make_rng(seed), source)
+        result.seed = seed
+        return result
+
+    def generate_many(self, source, style, n, workers=None, timeout=None, max_nodes=None, seed=None, cancel=None):
+        '''
+        Generate n poems, yielding each PoemResult as soon as it's done
+
+        Every poem shares the same warmed up models and search indexes. With
+        workers set, poems are generated in that many processes at once and
+        come back in whatever order they finish. Otherwise seed and cancel
+        work like they do for generate(), with one random generator seeded
+        for the whole run
+        '''
+        text_sources = self.text_sources
+        invalid = self.check_request(source, style, text_sources)
+        if invalid is not None:
+            yield invalid
+            return
+
+        if workers:
+            yield from generate_batch(self, source, style, n, workers, timeout, max_nodes)
+            return
+
+        models = text_sources[source]
+        rhyme_search = self._rhyme_search(source, models) if seed is None else None
+        rng = make_rng(seed)
+        for _ in range(n):
+            yield self.run_style(models, style, SearchBudget(timeout, max_nodes, cancel), rhyme_search, rng, source)
+
+    def add_style(self, name, pattern, definitions):
+        '''
+        Compile a rhyming form (see PoemPlan) and serve it as the style name.
+        Raises ValueError if the form doesn't make sense
+        '''
+        plan = compile_form(pattern, definitions)
+        self.poem_styles = {**self.poem_styles, name: plan}
+        return plan
+
+    def find_style(self, style):
+        '''
+        The style called style, or None. style can also be a form made up on
+        the spot, {'pattern': ..., 'meters': {rhyme: meter}}, which is compiled
+        the first time it's seen and remembered after that. Raises ValueError
+        if the form doesn't make sense
+        '''
+        if isinstance(style, str):
+            return self.poem_styles.get(style)
+        if not isinstance(style, dict) or 'pattern' not in style or 'meters' not in style:
+            raise ValueError("A form needs a 'pattern' and 'meters'")
+        return compile_form(style['pattern'], style['meters'])
+
+    def _check_style(self, style):
+        # a PoemResult saying what's wrong with the style, or None if it's fine
+        try:
+            if self.find_style(style) is not None:
+                return None
+        except ValueError as e:
+            return PoemResult(f'Invalid form: {e}', INVALID)
+        return PoemResult(f'Style not found: {style}. Valid choices are {", ".join(self.poem_styles)}', INVALID)
+
+    def check_request(self, source, style, text_sources=None):
+        '''
+        Return a PoemResult explaining what's wrong if a poem can't be
+        generated for this source and style, or None if it can
+        '''
+        if text_sources is None:
+            text_sources = self.text_sources
         if not self.set_up:
-            return 'Please run setup() first to initialize models'
-        if source not in self.text_sources:
-            return f'Source not found: {source}. Valid choices are {", ".join(self.text_sources)}'
-        if style not in self.poem_styles:
-            return f'Style not found: {style}. Valid choices are {", ".join(self.poem_styles)}'
-
-        d, rev_d, seeds = self.text_sources[source]
-        return '\n'.join(self.poem_styles[style](d=d, rev_d=rev_d, seeds=seeds))
-
-    # whoops - can't cache build_models because the input is an unhashable list
-    # so give it a wrapper
-    @lru_cache(maxsize=32)
+            return PoemResult('Please run setup() first to initialize models', INVALID)
+        if source not in text_sources:
+            return PoemResult(f'Source not found: {source}. Valid choices are {", ".join(text_sources)}', INVALID)
+        return self._check_style(style)
+
+    def _form_index(self, rev_index, plan):
+        # forms made up on the spot can ask for any meters at all, and the
+        # source's index would remember every state searched in each of them
+        # for as long as the source is around. so they get scratch indexes
+        # instead, and only the FORM_INDEXES most recently used are kept
+        key = tuple(plan.groups.values())
+        with self._form_lock:
+            indexes = self._form_indexes.get(rev_index)
+            if indexes is None:
+                indexes = self._form_indexes[rev_index] = OrderedDict()
+            index = indexes.get(key)
+            if index is None:
+                index = indexes[key] = rev_index.scratch()
+                while len(indexes) > FORM_INDEXES:
+                    indexes.popitem(last=False)
+            else:
+                indexes.move_to_end(key)
+        return index
+
+    def run_style(self, models, style, budget, rhyme_search=None, rng=random, source='custom'):
+        found = self.find_style(style)
+        if not isinstance(style, str):
+            # the parallel workers' indexes would remember the form's meters
+            # too, so search it right here
+            models = models._replace(rev_index=self._form_index(models.rev_index, found))
+            rhyme_search = None
+        # forms made up on the spot all share one label, so there's no end
+        # of them
+        with metrics.labelled(source=source, style=style if isinstance(style, str) else 'custom form'):
+            start = time.perf_counter()
+            try:
+                poem = '\n'.join(found(budget=budget, rhyme_search=rhyme_search, rng=rng, **models._asdict()))
+                result = PoemResult(poem, OK if poem else EXHAUSTED, budget.nodes, budget.retries)
+            except SearchLimitReached as e:
+                result = PoemResult('', e.reason, budget.nodes, budget.retries)
+            if metrics.enabled:
+                record_search(result, budget, time.perf_counter() - start)
+        return result
+
     def build_custom_models(self, source_text):
-        return build_models([source_text])
+        return self.custom_models.get_or_build(source_text)
 
-    def generate_custom(self, source_text, style):
-        d, rev_d, seeds = self.build_custom_models(source_text)
-        return '\n'.join(self.poem_styles[style](d=d, rev_d=rev_d, seeds=seeds))
+    def generate_custom(self, source_text, style, timeout=None, max_nodes=None, seed=None, cancel=None):
+        invalid = self._check_style(style)
+        if invalid is not None:
+            return invalid
+        # start the clock before building, so the timeout covers that too
+        budget = SearchBudget(timeout, max_nodes, cancel)
+        with metrics.labelled(source='custom', style=style if isinstance(style, str) else 'custom form'), \
+                metrics.timed('stage_seconds', stage='build'):
+            models = self.build_custom_models(source_text)
+        # the cached models' own indexes would keep growing with every poem,
+        # out of sight of the cache's byte budget, so each poem searches
+        # fresh ones that go when it's done
+        models = models._replace(index=SuccessorIndex(models.d, models.lexicon),
+                                 rev_index=SuccessorIndex(models.rev_d, models.lexicon))
+        result = self.run_style(models, style, budget, rng=make_rng(seed))
+        result.seed = seed
+        return result
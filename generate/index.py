@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+from . import metrics
+from .lexicon import Lexicon
+from .limits import SearchBudget
+from .markov import Successors, successors
+from .scansion import as_meter, fits_end
+
+
+class SuccessorIndex:
+    '''
+    The successors of each word in a Markov dictionary, grouped by syllable
+    fingerprint, so the searches can look up the successors that fit what's
+    left of a line instead of checking every one
+
+    Each word's groups are worked out the first time the word is visited, and
+    the successors that fit each remaining meter are remembered, so hub words
+    like "the" only get sorted through once.
+
+    The index also remembers dead ends: (word, remaining meter) states that
+    the searches have fully explored without finishing a line. Whether a
+    state can finish a line doesn't depend on how the search got there, so
+    those never need exploring again.
+
+    It knows which rhyme sounds can possibly give enough lines in a given
+    meter, so poems only pick from those.
+
+    Finally, it knows which words can start a run of words with exactly a
+    given number of syllables, so lines counted in syllables (haiku) can be
+    walked straight through without ever backtracking.
+    '''
+    def __init__(self, d, lexicon=None):
+        self.d = d
+        self.lexicon = lexicon if lexicon is not None else Lexicon()
+        self._by_fingerprint = {}
+        self._fitting_meter = {}
+        self.dead_meter = set()
+        self.alive_meter = set()
+        self._viable_rhymes = {}
+        # _syllable_reach[n] is (starts in sorted order, set of the same) for
+        # runs of n syllables. 0 has none
+        self._syllable_reach = [([], set())]
+        self._reaching_syllables = {}
+
+    def __getstate__(self):
+        # the groups and what we know about each state are cheap to relearn
+        # and can be big, so don't save them
+        return {'d': self.d, 'lexicon': self.lexicon}
+
+    def __setstate__(self, state):
+        self.__init__(state['d'], state['lexicon'])
+
+    def extended(self, d, changed):
+        '''
+        A new index over d, a copy of this index's dictionary where only the
+        words in changed have gained successors. What's still true carries
+        over: the groups of every other word, and the states known to finish
+        a line, since more successors never take a way to finish away. Dead
+        ends might not be dead anymore, so those are forgotten
+        '''
+        index = SuccessorIndex(d, self.lexicon)
+        index._by_fingerprint = dict(self._by_fingerprint)
+        for word in changed:
+            index._by_fingerprint.pop(word, None)
+        index.alive_meter = set(self.alive_meter)
+        return index
+
+    def scratch(self):
+        '''
+        A new index over the same dictionary that shares this one's groups,
+        of which there's at most one per word, but learns everything else
+        (what fits each meter, dead ends, viable rhymes) on its own. For
+        searches whose meters shouldn't be remembered for as long as this
+        index is, e.g. forms made up on the fly
+        '''
+        index = SuccessorIndex(self.d, self.lexicon)
+        index._by_fingerprint = self._by_fingerprint
+        return index
+
+    def _group(self, word, groups, key):
+        grouped = groups.get(word)
+        if grouped is None:
+            grouped = {}
+            options = successors(self.d, word)
+            for i, option in enumerate(options.words):
+                counts = grouped.setdefault(key(option), {})
+                counts[option] = options.weight(i)
+            groups[word] = grouped
+        return grouped
+
+    def by_fingerprint(self, word):
+        '''
+        {packed syllable fingerprint: {successor: count}} for the word's
+        successors
+        '''
+        return self._group(word, self._by_fingerprint, self.lexicon.meter)
+
+    def fitting_meter(self, word, pattern):
+        '''
+        The Successors of the word whose meter fits at the end of the pattern,
+        which is packed with scansion.encode
+        '''
+        key = (word, pattern)
+        fitting = self._fitting_meter.get(key)
+        if fitting is None:
+            counts = {}
+            for fp, group in self.by_fingerprint(word).items():
+                if fits_end(fp, pattern):
+                    counts.update(group)
+            fitting = self._fitting_meter[key] = Successors.from_counts(counts)
+        return fitting
+
+    def _reaches(self, word, num_syllables, levels):
+        syllables = self.lexicon.syllables(word)
+        return syllables == num_syllables or (syllables < num_syllables and word in levels[num_syllables][1])
+
+    def syllable_starts(self, num_syllables):
+        '''
+        The words in the dictionary that start at least one run of words
+        (following the dictionary) with exactly num_syllables syllables
+        between them, sorted. The order doesn't depend on how the dictionary
+        is stored (plain, compact and mapped ones iterate differently), so a
+        seeded walk picks the same start from any of them
+
+        Worked out for every count up to num_syllables the first time it's
+        asked for, then remembered. A word is in the table for n if it has n
+        syllables, or s < n and one of its successors is in the table for n - s
+        '''
+        levels = self._syllable_reach
+        if num_syllables < len(levels):
+            return levels[num_syllables][0]
+
+        lexicon = self.lexicon
+        d = self.d
+        levels = list(levels)
+        for n in range(len(levels), num_syllables + 1):
+            level = set()
+            levels.append(([], level))
+            zero = []
+            for word in d:
+                syllables = lexicon.syllables(word)
+                if syllables == n:
+                    level.add(word)
+                elif syllables == 0:
+                    zero.append(word)
+                elif syllables < n:
+                    rest = n - syllables
+                    if any(self._reaches(option, rest, levels) for option in successors(d, word).words):
+                        level.add(word)
+            # words with no syllables can lead on to others at the same
+            # count, so keep going round them until nothing changes
+            changed = True
+            while changed:
+                changed = False
+                for word in zero:
+                    if word not in level and any(self._reaches(option, n, levels)
+                                                 for option in successors(d, word).words):
+                        level.add(word)
+                        changed = True
+            levels[n][0].extend(sorted(level))
+        self._syllable_reach = levels
+        return levels[num_syllables][0]
+
+    def reaching_syllables(self, word, num_syllables):
+        '''
+        The Successors of the word that start a run of exactly num_syllables
+        syllables, i.e. the ones worth picking to carry on a line with that
+        many syllables left
+        '''
+        key = (word, num_syllables)
+        reaching = self._reaching_syllables.get(key)
+        if reaching is None:
+            self.syllable_starts(num_syllables)
+            levels = self._syllable_reach
+            options = successors(self.d, word)
+            counts = {option: options.weight(i) for i, option in enumerate(options.words)
+                      if self._reaches(option, num_syllables, levels)}
+            reaching = self._reaching_syllables[key] = Successors.from_counts(counts)
+        return reaching
+
+    def can_finish(self, word, pattern, budget=None):
+        '''
+        True if some run of words starting from word (following the Markov
+        dictionary) fills the pattern exactly
+
+        The answer for every state visited along the way is remembered, so
+        asking about lots of words costs about as much as asking about one
+        '''
+        if budget is None:
+            budget = SearchBudget()
+        pattern = as_meter(pattern)
+        lexicon = self.lexicon
+        alive = self.alive_meter
+        dead = self.dead_meter
+
+        if (word, pattern) in alive:
+            return True
+        if (word, pattern) in dead or not lexicon.valid_option(word, pattern):
+            return False
+        if lexicon.fulfills_scansion(word, pattern):
+            alive.add((word, pattern))
+            return True
+
+        budget.expand()
+        rest = lexicon.remaining_scheme(word, pattern)
+        stack = [(word, pattern, rest, iter(self.fitting_meter(word, rest)))]
+        while stack:
+            word, pattern, rest, options = stack[-1]
+            for option in options:
+                if (option, rest) in dead:
+                    budget.memo_hits += 1
+                    continue
+                if (option, rest) in alive or lexicon.fulfills_scansion(option, rest):
+                    # everything on the way here can finish a line too
+                    alive.add((option, rest))
+                    alive.update((w, p) for w, p, *_ in stack)
+                    return True
+                budget.expand()
+                option_rest = lexicon.remaining_scheme(option, rest)
+                stack.append((option, rest, option_rest, iter(self.fitting_meter(option, option_rest))))
+                break
+            else:
+                stack.pop()
+                dead.add((word, pattern))
+                budget.dead_ends += 1
+
+        return False
+
+    def viable_rhymes(self, seeds, pattern, k, budget=None):
+        '''
+        The rhyme sounds in seeds with at least k words that can end a line in
+        the pattern, i.e. the only ones worth trying for k rhyming lines
+
+        Worked out the first time each (pattern, k) is asked for, then
+        remembered. seeds should be the rhyme seeds built alongside this
+        index's dictionary
+        '''
+        pattern = as_meter(pattern)
+        viable = self._viable_rhymes.get((pattern, k))
+        metrics.inc('index_cache_total', cache='viable_rhymes', result='miss' if viable is None else 'hit')
+        if viable is None:
+            viable = [rhyme_sound for rhyme_sound, words in seeds.items()
+                      if sum(1 for word in words if self.can_finish(word, pattern, budget)) >= k]
+            self._viable_rhymes[pattern, k] = viable
+        return viable
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import locale
+import logging
+import os
+import resource
+import time
+
+from .poems import ModelBuilder
+
+
+def source_files(path):
+    '''
+    The text files that make up a source: just the file itself, or every file
+    under a directory (skipping hidden ones), in a stable order
+    '''
+    if not os.path.isdir(path):
+        return [path]
+
+    files = []
+    for folder, subfolders, filenames in os.walk(path):
+        subfolders[:] = sorted(f for f in subfolders if not f.startswith('.'))
+        files.extend(os.path.join(folder, f) for f in sorted(filenames) if not f.startswith('.'))
+    return files
+
+
+def source_name(filename):
+    '''
+    The name a source goes by: the file name without its extension, or the
+    directory name
+    '''
+    return os.path.splitext(filename)[0]
+
+
+def is_break(line):
+    return line in (b'\n', b'\r\n')
+
+
+def feed_file(builder, filepath, start=0, end=None):
+    '''
+    Stream a file, or the bytes from start to end of it, into a ModelBuilder
+    a line at a time. Paragraph breaks (an empty line) separate chunks, like
+    get_file, and so does the end of the file
+    '''
+    encoding = locale.getpreferredencoding(False)
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            if is_break(line):
+                builder.end_chunk()
+            else:
+                builder.feed_line(line.decode(encoding))
+    builder.end_chunk()
+
+
+def plan_shards(path, shard_size=None):
+    '''
+    Split a source into (filepath, start, end) byte ranges of about
+    shard_size bytes that can be built separately and merged. Every range
+    ends on a paragraph break (or the end of a file), so no two consecutive
+    words are ever split between shards
+    '''
+    shards = []
+    for filepath in source_files(path):
+        size = os.path.getsize(filepath)
+        start = 0
+        with open(filepath, 'rb') as f:
+            while shard_size and size - start > shard_size:
+                f.seek(start + shard_size)
+                f.readline()  # skip to the start of a line
+                for line in iter(f.readline, b''):
+                    if is_break(line):
+                        break
+                end = f.tell()
+                if end >= size:
+                    break
+                shards.append((filepath, start, end))
+                start = end
+        shards.append((filepath, start, size))
+    return shards
+
+
+def build_shard(filepath, start, end):
+    builder = ModelBuilder()
+    feed_file(builder, filepath, start, end)
+    return builder
+
+
+def timed_shard(filepath, start, end):
+    '''
+    build_shard, and how many seconds it took in the worker
+    '''
+    started = time.perf_counter()
+    builder = build_shard(filepath, start, end)
+    return builder, time.perf_counter() - started
+
+
+def build_sources(sources, workers=None, shard_size=None, progress=None):
+    '''
+    Build the models for several sources, given as {name: path}, and return
+    {name: (models, seconds it took)}
+
+    With workers set, the sources are split into shards that are built in a
+    pool of that many processes and merged back together in order, which
+    gives exactly the same models as building each source in one go. Big
+    sources are split every shard_size bytes so they can use more than one
+    process too. progress, if given, is called with (name, shards done,
+    total shards) as shards finish, in whatever order they finish
+
+    A source's time is how long its shards took in the workers plus how long
+    merging them took, not counting time spent waiting for a free worker
+    '''
+    built = {}
+    if not workers:
+        for name, path in sources.items():
+            start = time.perf_counter()
+            built[name] = (build_source(path), time.perf_counter() - start)
+            if progress is not None:
+                progress(name, 1, 1)
+        return built
+
+    with ProcessPoolExecutor(workers) as executor:
+        # {future: (name, shard number)}
+        futures = {}
+        totals = {}
+        for name, path in sources.items():
+            shards = plan_shards(path, shard_size)
+            totals[name] = len(shards)
+            for i, shard in enumerate(shards):
+                futures[executor.submit(timed_shard, *shard)] = (name, i)
+
+        # {name: builder with every shard up to the first missing one merged in}
+        builders = {}
+        merged = dict.fromkeys(sources, 0)
+        seconds = dict.fromkeys(sources, 0.0)
+        # {name: {shard number: builder}} for shards that finished early
+        waiting = {name: {} for name in sources}
+
+        for future in as_completed(futures):
+            name, i = futures[future]
+            builder, shard_seconds = future.result()
+            waiting[name][i] = builder
+            if progress is not None:
+                progress(name, merged[name] + len(waiting[name]), totals[name])
+
+            # merge in order, so the models come out the same as building the
+            # source in one go
+            start = time.perf_counter()
+            while merged[name] in waiting[name]:
+                builder = waiting[name].pop(merged[name])
+                if name in builders:
+                    builders[name].merge(builder)
+                else:
+                    builders[name] = builder
+                merged[name] += 1
+            if merged[name] == totals[name]:
+                built[name] = builders.pop(name).build()
+            seconds[name] += shard_seconds + time.perf_counter() - start
+
+        finished, built = built, {}
+        for name in sources:
+            # a source with no files in it never got a builder
+            built[name] = (finished.get(name) or ModelBuilder().build(), seconds[name])
+            logging.info('Built %s from %d shards in %.2fs', name, totals[name], seconds[name])
+
+    return built
+
+
+def build_source(path, builder=None):
+    '''
+    Build the models for a source file or directory without reading all of
+    it into memory at once
+    '''
+    if builder is None:
+        builder = ModelBuilder()
+    for filepath in source_files(path):
+        feed_file(builder, filepath)
+    return builder.build()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build models from source files or directories and report ingestion speed')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        size = sum(os.path.getsize(f) for f in source_files(path))
+        start = time.perf_counter()
+        models = build_source(path)
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is in KiB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{path}: {size / 2**20:.1f} MiB in {elapsed:.2f}s ({size / 2**20 / elapsed:.2f} MiB/s), '
+              f'{len(models.lexicon)} words, peak RSS {peak:.0f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from .scansion import drop_end, encode, fits_end, matches
+from .syllables import count_syllables, rhyme_fingerprint, syllable_fingerprint
+
+FINGERPRINT, SYLLABLES, RHYME, METER = range(4)
+
+
+class Lexicon:
+    '''
+    A table of the phonetic facts the generators need about every word in a
+    vocabulary: its syllable fingerprint, its syllable count, its rhyme
+    fingerprint, and its syllable fingerprint packed into an int (see
+    scansion.py), which is what the meter checks below work on.
+
+    Each word is cleaned and looked up in the pronunciation dictionary once,
+    when it's added, rather than on every step of the backtracking search.
+    Words that aren't in the table yet are added the first time they're asked
+    about, so a fresh Lexicon also works as a plain cache.
+
+    It also keeps the words it knows grouped by rhyme fingerprint in rhymes,
+    including sounds only one word has so far, so the rhyme seeds can be
+    worked out again when more words turn up.
+    '''
+    def __init__(self, words=()):
+        self.entries = {}
+        self.rhymes = {}
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, word):
+        return word in self.entries
+
+    def add(self, word):
+        entry = self.entries.get(word)
+        if entry is None:
+            fp = syllable_fingerprint(word)
+            entry = (fp, count_syllables(word), rhyme_fingerprint(word), encode(fp))
+            self.insert(word, entry)
+        return entry
+
+    def insert(self, word, entry):
+        '''
+        Add a word whose entry is already known, e.g. from another Lexicon
+        '''
+        self.entries[word] = entry
+        if entry[RHYME] is not None:
+            self.rhymes.setdefault(entry[RHYME], []).append(word)
+
+    def fingerprint(self, word):
+        return self.add(word)[FINGERPRINT]
+
+    def syllables(self, word):
+        return self.add(word)[SYLLABLES]
+
+    def rhyme(self, word):
+        return self.add(word)[RHYME]
+
+    def meter(self, word):
+        return self.add(word)[METER]
+
+    # the desired meters below are packed with scansion.encode
+
+    def fulfills_scansion(self, word, desired_fp):
+        '''
+        True if the word's meter and the desired meter are compatible
+        '''
+        return matches(self.meter(word), desired_fp)
+
+    def valid_option(self, word, desired_fp):
+        '''
+        True if the word's meter is compatible at the end of the desired meter
+        '''
+        return fits_end(self.meter(word), desired_fp)
+
+    def remaining_scheme(self, word, remaining_syl):
+        '''
+        Cut off the word's length and return the remaining meter to look for
+        '''
+        return drop_end(self.meter(word), remaining_syl)
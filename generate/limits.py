@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import time
+
+# why generation stopped
+OK = 'ok'
+EXHAUSTED = 'exhausted'  # searched everything without finding a poem
+DEADLINE = 'deadline'
+BUDGET = 'budget'
+CANCELLED = 'cancelled'  # whoever asked for the poem gave up on it
+INVALID = 'invalid'  # bad source or style, or not set up
+
+
+class SearchLimitReached(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class SearchBudget:
+    '''
+    Limits on one poem search: a wall clock timeout in seconds, and a cap on
+    the number of search nodes expanded. Either can be None for no limit.
+
+    The searches call expand() once per node, which raises SearchLimitReached
+    as soon as either limit is passed. They also count retries, i.e. rhyme
+    sounds that were tried and didn't work out, dead ends they found, and
+    memo hits, i.e. states skipped because they were already known dead.
+
+    cancel is an optional threading.Event; setting it from any thread stops
+    the search at the next node, e.g. when the request it's for goes away.
+    '''
+    def __init__(self, timeout=None, max_nodes=None, cancel=None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.max_nodes = max_nodes
+        self.cancel = cancel
+        self.nodes = 0
+        self.retries = 0
+        self.dead_ends = 0
+        self.memo_hits = 0
+
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise SearchLimitReached(CANCELLED)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise SearchLimitReached(DEADLINE)
+
+    def expand(self, nodes=1):
+        self.nodes += nodes
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchLimitReached(BUDGET)
+        self.check()
+
+    def remaining_time(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def remaining_nodes(self):
+        if self.max_nodes is None:
+            return None
+        return max(self.max_nodes - self.nodes, 0)
+
+
+class PoemResult(str):
+    '''
+    The text of a generated poem, which can be used anywhere the plain string
+    could, along with why generation stopped (status), how many search nodes
+    it took, how many rhyme sounds it had to retry, and the seed it was
+    generated with, if any. A poem that couldn't be finished is an empty
+    string.
+    '''
+    def __new__(cls, text='', status=OK, nodes=0, retries=0, seed=None):
+        result = super().__new__(cls, text)
+        result.status = status
+        result.nodes = nodes
+        result.retries = retries
+        result.seed = seed
+        return result
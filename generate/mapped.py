@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+'''
+A read-only file format for models that can be memory mapped, so every
+process serving poems from a source shares one copy of it in the page cache
+instead of each holding its own in Python objects
+
+Everything is in flat arrays that are read in place through memoryviews:
+
+- the vocabulary, sorted by its utf-8 bytes so a word's id can be found with
+  a binary search
+- the forward and reverse Markov dictionaries as compressed sparse rows (see
+  CompactModel) over those ids
+- each word's syllable fingerprint, syllable count and rhyme class
+- the rhyme classes: each rhyme fingerprint and the ids of its words, in the
+  order the lexicon had them
+
+The file starts with a magic line, the key it was built under, and a JSON
+table of where each array starts, how long it is and what type it holds.
+
+To write them ahead of time (e.g. when building an image), run
+python -m generate.mapped
+'''
+
+import argparse
+from array import array
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import mmap
+import os
+import sys
+import threading
+import time
+
+from .index import SuccessorIndex
+from .lexicon import FINGERPRINT, RHYME, SYLLABLES, Lexicon
+from .markov import Successors, _Interned, successors
+from .poems import Models
+from .scansion import encode
+
+MAGIC = b'PYAMBIC-MAPPED'
+
+# the arrays in the file, each with its array typecode
+SECTIONS = {
+    'word_offsets': 'Q', 'word_bytes': 'B',
+    'd_offsets': 'Q', 'd_targets': 'I', 'd_totals': 'I',
+    'rev_offsets': 'Q', 'rev_targets': 'I', 'rev_totals': 'I',
+    'fp_offsets': 'Q', 'fp_bytes': 'B',
+    'syllables': 'I', 'rhyme_ids': 'i',
+    'rhyme_offsets': 'Q', 'rhyme_bytes': 'B',
+    'class_offsets': 'Q', 'class_words': 'I',
+}
+
+
+def mapped_path(filepath):
+    '''
+    Mapped models live next to their source as hidden files, like snapshots
+    '''
+    folder, filename = os.path.split(filepath)
+    return os.path.join(folder, f'.{filename}.mapped')
+
+
+def lock_path(filepath):
+    return f'{mapped_path(filepath)}.lock'
+
+
+@contextmanager
+def lock_mapped(filepath):
+    '''
+    Hold the lock on a source's mapped file, waiting for whoever has it
+    first. Only the holder should build and write the file, so processes
+    that start together build each source once and all map the same file
+    '''
+    try:
+        f = open(lock_path(filepath), 'a')
+    except OSError:
+        # e.g. a read-only data folder, where nobody can write the mapped
+        # file either
+        logging.warning('Could not open the lock for %s', filepath, exc_info=True)
+        yield
+        return
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except OSError:
+            logging.warning('Could not lock %s', filepath, exc_info=True)
+        # closing the file lets go of the lock
+        yield
+
+
+def _strings(strings):
+    '''
+    Pack strings into (offsets, bytes) arrays
+    '''
+    offsets = array('Q', [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, array('B', blob)
+
+
+def write_mapped(models, path, key):
+    '''
+    Lay models out in the mapped format and save them to path
+    '''
+    lexicon = models.lexicon
+    vocabulary = set(lexicon.entries)
+    vocabulary.update(models.d)
+    vocabulary.update(models.rev_d)
+    words = sorted(vocabulary, key=lambda word: word.encode('utf-8'))
+    ids = {word: i for i, word in enumerate(words)}
+    entries = [lexicon.add(word) for word in words]
+
+    arrays = {}
+    arrays['word_offsets'], arrays['word_bytes'] = _strings(words)
+    for name, d in (('d', models.d), ('rev', models.rev_d)):
+        offsets, targets, totals = array('Q', [0]), array('I'), array('I')
+        for word in words:
+            options = successors(d, word)
+            targets.extend(ids[option] for option in options.words)
+            totals.extend(options.totals)
+            offsets.append(len(targets))
+        arrays[f'{name}_offsets'], arrays[f'{name}_targets'], arrays[f'{name}_totals'] = offsets, targets, totals
+
+    arrays['fp_offsets'], arrays['fp_bytes'] = _strings(entry[FINGERPRINT] for entry in entries)
+    arrays['syllables'] = array('I', (entry[SYLLABLES] for entry in entries))
+
+    rhymes = list(lexicon.rhymes.items())
+    class_ids = {rf: i for i, (rf, _) in enumerate(rhymes)}
+    arrays['rhyme_ids'] = array('i', (class_ids.get(entry[RHYME], -1) for entry in entries))
+    arrays['rhyme_offsets'], arrays['rhyme_bytes'] = _strings(' '.join(rf) for rf, _ in rhymes)
+    arrays['class_offsets'] = array('Q', [0])
+    arrays['class_words'] = array('I')
+    for _, members in rhymes:
+        arrays['class_words'].extend(ids[word] for word in members)
+        arrays['class_offsets'].append(len(arrays['class_words']))
+
+    header = MAGIC + b'\n' + key.encode() + b'\n'
+    # the table of contents has to know where the data starts, which depends
+    # on how long the table is, so lay it out until it stops moving
+    start = 0
+    while True:
+        table = {'byteorder': sys.byteorder, 'sections': {}}
+        position = start
+        for name in SECTIONS:
+            size = len(arrays[name]) * arrays[name].itemsize
+            table['sections'][name] = [position, len(arrays[name])]
+            position += size + -size % 8
+        toc = json.dumps(table).encode() + b'\n'
+        needed = len(header) + len(toc)
+        needed += -needed % 8
+        if needed == start:
+            break
+        start = needed
+
+    # write somewhere else first so a half-written file is never mapped
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header + toc)
+        f.write(b'\0' * (start - len(header) - len(toc)))
+        for name in SECTIONS:
+            data = arrays[name].tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % 8))
+    os.replace(tmp_path, path)
+
+
+class _Vocabulary(Sequence):
+    '''
+    The sorted words in a mapped file, by id
+    '''
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _bytes(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return self._bytes(i).decode('utf-8')
+
+    def find(self, word):
+        '''
+        The id of the word, or None if it's not there
+        '''
+        key = word.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._bytes(lo) == key:
+            return lo
+        return None
+
+
+class MappedModel(Mapping):
+    '''
+    A Markov dictionary read straight out of a mapped file. Behaves like the
+    {word: Successors} dictionaries build_models makes
+    '''
+    def __init__(self, vocabulary, offsets, targets, totals):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.targets = targets
+        self.totals = totals
+        self._len = None
+
+    def _range(self, word):
+        i = self.vocabulary.find(word)
+        if i is None:
+            return 0, 0
+        return self.offsets[i], self.offsets[i + 1]
+
+    def __getitem__(self, word):
+        start, end = self._range(word)
+        if start == end:
+            raise KeyError(word)
+        return Successors(_Interned(self.vocabulary, self.targets[start:end]), self.totals[start:end])
+
+    def __contains__(self, word):
+        start, end = self._range(word)
+        return start != end
+
+    def __iter__(self):
+        offsets = self.offsets
+        for i in range(len(offsets) - 1):
+            if offsets[i] != offsets[i + 1]:
+                yield self.vocabulary[i]
+
+    def __len__(self):
+        if self._len is None:
+            offsets = self.offsets
+            self._len = sum(1 for i in range(len(offsets) - 1) if offsets[i] != offsets[i + 1])
+        return self._len
+
+
+class MappedLexicon(Lexicon):
+    '''
+    A Lexicon whose words come from a mapped file. Entries are read out of
+    the file the first time each word is asked about and kept, so a process
+    only ever holds the words it's actually used. Words that aren't in the
+    file are worked out and added as usual
+    '''
+    def __init__(self, vocabulary, sections):
+        super().__init__()
+        self.vocabulary = vocabulary
+        self.sections = sections
+        self.added = 0
+        self._class_ids = None
+
+    def __len__(self):
+        return len(self.vocabulary) + self.added
+
+    def __contains__(self, word):
+        return word in self.entries or self.vocabulary.find(word) is not None
+
+    def _string(self, name, i):
+        offsets = self.sections[f'{name}_offsets']
+        return bytes(self.sections[f'{name}_bytes'][offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def rhyme_key(self, class_id):
+        return tuple(self._string('rhyme', class_id).split())
+
+    def class_members(self, class_id):
+        offsets = self.sections['class_offsets']
+        return self.sections['class_words'][offsets[class_id]:offsets[class_id + 1]]
+
+    def add(self, word):
+        entry = self.entries.get(word)
+        if entry is None:
+            i = self.vocabulary.find(word)
+            if i is None:
+                self.added += 1
+                return super().add(word)
+            fp = self._string('fp', i)
+            class_id = self.sections['rhyme_ids'][i]
+            rhyme = self.rhyme_key(class_id) if class_id >= 0 else None
+            entry = self.entries[word] = (fp, self.sections['syllables'][i], rhyme, encode(fp))
+        return entry
+
+    def insert(self, word, entry):
+        # a new word joining one of the file's rhyme classes takes the whole
+        # class with it, so the seeds can be worked out again
+        rf = entry[RHYME]
+        if rf is not None and rf not in self.rhymes:
+            if self._class_ids is None:
+                self._class_ids = {self.rhyme_key(i): i for i in range(len(self.sections['class_offsets']) - 1)}
+            class_id = self._class_ids.get(rf)
+            if class_id is not None:
+                self.rhymes[rf] = [self.vocabulary[j] for j in self.class_members(class_id)]
+        super().insert(word, entry)
+
+
+class MappedSeeds(Mapping):
+    '''
+    {rhyme fingerprint: [words]} for the rhyme classes in a mapped file with
+    at least two words, like the seeds build_models makes
+    '''
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+        offsets = lexicon.sections['class_offsets']
+        self._ids = {}
+        for i in range(len(offsets) - 1):
+            if offsets[i + 1] - offsets[i] >= 2:
+                self._ids[lexicon.rhyme_key(i)] = i
+
+    def __getitem__(self, rf):
+        vocabulary = self.lexicon.vocabulary
+        return [vocabulary[j] for j in self.lexicon.class_members(self._ids[rf])]
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def open_mapped(path, key):
+    '''
+    Map the models saved at path, or return None if there aren't any or they
+    were saved under a different key
+    '''
+    try:
+        with open(path, 'rb') as f:
+            if f.readline().rstrip(b'\n') != MAGIC or f.readline().rstrip(b'\n').decode() != key:
+                return None
+            table = json.loads(f.readline())
+            if table['byteorder'] != sys.byteorder:
+                return None
+            # the map stays open as long as anything is reading from it
+            mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError):
+        logging.warning('Ignoring unreadable mapped models in %s', path, exc_info=True)
+        return None
+
+    sections = {}
+    for name, typecode in SECTIONS.items():
+        start, count = table['sections'][name]
+        itemsize = array(typecode).itemsize
+        sections[name] = mapped[start:start + count * itemsize].cast(typecode)
+
+    vocabulary = _Vocabulary(sections['word_offsets'], sections['word_bytes'])
+    d = MappedModel(vocabulary, sections['d_offsets'], sections['d_targets'], sections['d_totals'])
+    rev_d = MappedModel(vocabulary, sections['rev_offsets'], sections['rev_targets'], sections['rev_totals'])
+    lexicon = MappedLexicon(vocabulary, sections)
+    return Models(d, rev_d, MappedSeeds(lexicon), lexicon, SuccessorIndex(d, lexicon), SuccessorIndex(rev_d, lexicon))
+
+
+def main():
+    from .generator import DATA_FOLDER
+    from .ingest import build_source
+    from .snapshot import snapshot_key
+
+    parser = argparse.ArgumentParser(description='Prebuild mapped models for every source in a data folder')
+    parser.add_argument('data_folder', nargs='?', default=DATA_FOLDER)
+    args = parser.parse_args()
+
+    for filename in sorted(os.listdir(args.data_folder)):
+        if filename.startswith('.'):
+            continue
+        filepath = os.path.join(args.data_folder, filename)
+        path = mapped_path(filepath)
+        key = snapshot_key(filepath)
+
+        with lock_mapped(filepath):
+            if open_mapped(path, key) is not None:
+                print(f'{filename}: up to date')
+                continue
+            start = time.perf_counter()
+            write_mapped(build_source(filepath), path, key)
+            build_time = time.perf_counter() - start
+
+        print(f'{filename}: built in {build_time:.3f}s ({os.path.getsize(path) / 1024:.0f} KiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import argparse
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping, Sequence
+from itertools import accumulate
+import random
+import sys
+
+
+class Successors(Sequence):
+    '''
+    The distinct words that can follow a word in a Markov model, with a
+    running total of how often each one did, so that picking the next word by
+    frequency is a binary search rather than a scan of every occurrence
+
+    e.g. 'the cat the dog the cat' gives the: Successors(['cat', 'dog'], [2, 3])
+    '''
+    __slots__ = ('words', 'totals')
+
+    def __init__(self, words, totals):
+        self.words = words
+        self.totals = totals
+
+    @classmethod
+    def from_counts(cls, counts):
+        '''
+        counts is a dictionary of {successor: number of times seen}
+        '''
+        return cls(tuple(counts), array('I', accumulate(counts.values())))
+
+    @classmethod
+    def from_list(cls, options):
+        '''
+        Convert a list with one entry per occurrence, as found in plain
+        {word: [successor, ...]} dictionaries
+        '''
+        counts = {}
+        for option in options:
+            counts[option] = counts.get(option, 0) + 1
+        return cls.from_counts(counts)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, i):
+        return self.words[i]
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __eq__(self, other):
+        return isinstance(other, Successors) and list(self.words) == list(other.words) \
+            and list(self.totals) == list(other.totals)
+
+    def __repr__(self):
+        return f'Successors({list(self.words)!r}, {list(self.totals)!r})'
+
+    def weight(self, i):
+        return self.totals[i] - (self.totals[i - 1] if i else 0)
+
+    def sample(self, rng=random):
+        '''
+        Pick one successor, weighted by how often it was seen
+        '''
+        return self.words[bisect_right(self.totals, rng.random() * self.totals[-1])]
+
+    def shuffled(self, rng=random):
+        '''
+        Yield every successor once, in a random order weighted by how often
+        each was seen, so frequent successors tend to be tried first
+
+        Draws come from the running totals, skipping successors that were
+        already yielded. Once more than half the weight is used up, the
+        totals are rebuilt over what's left so skips stay rare. Search
+        usually stops after the first few successors, so most of the time
+        nothing is ever rebuilt.
+        '''
+        words = self.words
+        totals = self.totals
+        counts = None
+        while words:
+            total = totals[-1]
+            left = total
+            seen = set()
+            while left * 2 > total:
+                i = bisect_right(totals, rng.random() * total)
+                if i in seen:
+                    continue
+                seen.add(i)
+                yield words[i]
+                left -= totals[i] - (totals[i - 1] if i else 0)
+
+            if counts is None:
+                counts = [self.weight(i) for i in range(len(self.words))]
+            rest = [i for i in range(len(words)) if i not in seen]
+            counts = [counts[i] for i in rest]
+            words = [words[i] for i in rest]
+            totals = list(accumulate(counts))
+
+
+EMPTY = Successors((), array('I'))
+
+MASK64 = 2**64 - 1
+
+
+class StateRandom:
+    '''
+    A small random generator (splitmix64) with just the random() that
+    Successors.shuffled needs. Unlike random.Random it costs next to nothing
+    to make, so a search can give every state it visits one of its own
+    '''
+    __slots__ = ('state',)
+
+    def __init__(self, seed):
+        self.state = seed & MASK64
+
+    def random(self):
+        self.state = z = (self.state + 0x9E3779B97F4A7C15) & MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+        return ((z ^ (z >> 31)) >> 11) / 2**53
+
+
+def successors(d, word):
+    '''
+    The Successors of a word in any kind of Markov dictionary, including plain
+    {word: [successor, ...]} ones
+    '''
+    options = d.get(word)
+    if options is None:
+        return EMPTY
+    if isinstance(options, Successors):
+        return options
+    return Successors.from_list(options)
+
+
+class _Interned(Sequence):
+    '''
+    A slice of word ids that reads back as words
+    '''
+    __slots__ = ('vocabulary', 'ids')
+
+    def __init__(self, vocabulary, ids):
+        self.vocabulary = vocabulary
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.vocabulary[self.ids[i]]
+
+
+class CompactModel(Mapping):
+    '''
+    A read-only Markov dictionary with every word interned to an integer id
+    and successors stored as compressed sparse row arrays: the distinct
+    successors of word i are targets[offsets[i]:offsets[i + 1]], and totals
+    holds their running counts over the same range
+
+    Behaves like the {word: Successors} dictionaries that build_models makes,
+    so the generators can use either one, but it takes a fraction of the
+    memory on big corpora.
+    '''
+    def __init__(self, words, offsets, targets, totals, ids=None):
+        self.words = words
+        self.ids = ids if ids is not None else {word: i for i, word in enumerate(words)}
+        self.offsets = offsets
+        self.targets = targets
+        self.totals = totals
+        self._len = sum(1 for i in range(len(offsets) - 1) if offsets[i] != offsets[i + 1])
+
+    @classmethod
+    def from_dict(cls, d, words=None, ids=None):
+        '''
+        Pack a Markov dictionary. Pass in words and ids to share one
+        vocabulary between several models; any words they're missing are
+        added to them.
+        '''
+        if words is None:
+            words, ids = [], {}
+
+        def intern(word):
+            i = ids.get(word)
+            if i is None:
+                i = ids[word] = len(words)
+                words.append(word)
+            return i
+
+        rows = {}
+        for word in d:
+            options = successors(d, word)
+            rows[intern(word)] = ([intern(option) for option in options.words], options.totals)
+
+        offsets = array('Q', [0])
+        targets = array('I')
+        totals = array('I')
+        for i in range(len(words)):
+            row_targets, row_totals = rows.get(i, ((), ()))
+            targets.extend(row_targets)
+            totals.extend(row_totals)
+            offsets.append(len(targets))
+
+        return cls(words, offsets, targets, totals, ids)
+
+    def _range(self, word):
+        i = self.ids.get(word)
+        if i is None or i >= len(self.offsets) - 1:
+            return 0, 0
+        return self.offsets[i], self.offsets[i + 1]
+
+    def __getitem__(self, word):
+        start, end = self._range(word)
+        if start == end:
+            raise KeyError(word)
+        return Successors(_Interned(self.words, self.targets[start:end]), self.totals[start:end])
+
+    def __contains__(self, word):
+        start, end = self._range(word)
+        return start != end
+
+    def __iter__(self):
+        offsets = self.offsets
+        for i in range(len(offsets) - 1):
+            if offsets[i] != offsets[i + 1]:
+                yield self.words[i]
+
+    def __len__(self):
+        return self._len
+
+
+def compact_models(models):
+    '''
+    Swap the forward and reverse dictionaries of a set of models for compact
+    ones sharing a single vocabulary
+    '''
+    from .index import SuccessorIndex
+
+    words, ids = [], {}
+    d = CompactModel.from_dict(models.d, words, ids)
+    rev_d = CompactModel.from_dict(models.rev_d, words, ids)
+    return models._replace(d=d, rev_d=rev_d,
+                           index=SuccessorIndex(d, models.lexicon), rev_index=SuccessorIndex(rev_d, models.lexicon))
+
+
+def sizeof(obj, seen=None):
+    '''
+    Roughly how many bytes an object and everything it holds onto take up
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item, seen) for item in obj)
+    elif isinstance(obj, Successors):
+        size += sizeof(obj.words, seen) + sizeof(obj.totals, seen)
+    elif isinstance(obj, CompactModel):
+        size += sum(sizeof(v, seen) for v in vars(obj).values())
+    return size
+
+
+def main():
+    from .ingest import build_source
+
+    parser = argparse.ArgumentParser(description='Compare the memory used by plain and compact Markov models')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    for filepath in args.files:
+        models = build_source(filepath)
+        compact = compact_models(models)
+
+        plain_size = sizeof((models.d, models.rev_d))
+        compact_size = sizeof((compact.d, compact.rev_d))
+        print(f'{filepath}: plain {plain_size / 2**20:.2f} MiB, compact {compact_size / 2**20:.2f} MiB '
+              f'({compact_size / plain_size:.0%})')
+
+
+if __name__ == '__main__':
+    main()
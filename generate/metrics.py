@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+from contextlib import nullcontext
+import threading
+import time
+
+# off by default. every hook checks this first, so turned off they cost about
+# one attribute lookup each, and none of them run per search node
+enabled = False
+
+# upper bounds of the histogram buckets for timings, in seconds
+BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+HELP = {
+    'poems_total': 'Poems generated, by how the search ended',
+    'poem_seconds': 'Time to generate a whole poem',
+    'stage_seconds': 'Time spent in each stage of generating a poem',
+    'search_nodes_total': 'Search nodes expanded',
+    'search_dead_ends_total': 'Search states found to be dead ends',
+    'search_memo_hits_total': 'Search states skipped because they were already known to be dead ends',
+    'rhyme_retries_total': "Rhyme sounds tried that didn't give enough lines",
+    'index_cache_total': 'Lookups in the search index caches, by whether they hit',
+    'syllable_fingerprint_seconds': 'Time to work out the syllable fingerprint of a word',
+    'pronunciation_misses_total': "Words not in the pronunciation dictionary, whose syllables had to be guessed",
+    'source_load_seconds': 'Time to load or build a catalog source when it was asked for',
+    'source_evictions_total': 'Catalog sources dropped from memory to make room for others',
+}
+
+_context = threading.local()
+_NOOP = nullcontext()
+
+
+def _key(name, labels):
+    # the current thread's labels (e.g. source and style) go on everything
+    context = getattr(_context, 'labels', None)
+    if context:
+        labels = dict(context, **labels)
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    '''
+    Counters and timing histograms, keyed by name and labels, that render as
+    Prometheus text
+    '''
+    def __init__(self):
+        self.counters = {}
+        # {key: [count per bucket..., count, sum]}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        '''
+        Everything recorded so far in the Prometheus text format
+        '''
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# HELP pyambic_{name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE pyambic_{name} counter')
+            for (other, labels), value in sorted(counters.items()):
+                if other == name:
+                    lines.append(f'pyambic_{name}{format_labels(labels)} {value}')
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# HELP pyambic_{name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE pyambic_{name} histogram')
+            for (other, labels), values in sorted(histograms.items()):
+                if other != name:
+                    continue
+                for bound, count in zip(BUCKETS, values):
+                    lines.append(f'pyambic_{name}_bucket{format_labels(labels + (("le", str(bound)),))} {count}')
+                lines.append(f'pyambic_{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {values[-2]}')
+                lines.append(f'pyambic_{name}_count{format_labels(labels)} {values[-2]}')
+                lines.append(f'pyambic_{name}_sum{format_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render_gauge(name, help, values):
+    '''
+    Prometheus text for a gauge that isn't kept in the registry, e.g. stats
+    read off something else when /metrics is asked for. values is {tuple of
+    (label, value) pairs: value}
+    '''
+    lines = [f'# HELP pyambic_{name} {help}', f'# TYPE pyambic_{name} gauge']
+    lines.extend(f'pyambic_{name}{format_labels(labels)} {value}' for labels, value in sorted(values.items()))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def inc(name, value=1, **labels):
+    if enabled:
+        registry.inc(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    if enabled:
+        registry.observe(name, seconds, **labels)
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def timed(name, **labels):
+    '''
+    with timed('stage_seconds', stage='rhyme'): ... records how long the
+    block took, if metrics are on
+    '''
+    if not enabled:
+        return _NOOP
+    return _Timer(name, labels)
+
+
+class _Labels:
+    __slots__ = ('labels', 'previous')
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        self.previous = getattr(_context, 'labels', None)
+        _context.labels = dict(self.previous or {}, **self.labels)
+        return self
+
+    def __exit__(self, *exc):
+        _context.labels = self.previous
+
+
+def labelled(**labels):
+    '''
+    with labelled(source=..., style=...): ... puts these labels on everything
+    this thread records inside the block
+    '''
+    if not enabled:
+        return _NOOP
+    return _Labels(labels)
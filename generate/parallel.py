@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import random
+
+from .limits import DEADLINE, SearchBudget, SearchLimitReached
+from .poems import generate_pattern
+
+# each worker process's own read-only copy of the models, {source: Models}
+_text_sources = None
+
+
+def _init_worker(text_sources):
+    global _text_sources
+    _text_sources = text_sources
+
+
+def _find_pattern(source, rhyme_sound, meter, k, timeout, max_nodes):
+    '''
+    Runs in a worker: try to find k lines in the meter ending in the rhyme
+    sound. Returns the lines (or None) and how many nodes it took
+    '''
+    models = _text_sources[source]
+    budget = SearchBudget(timeout, max_nodes)
+    try:
+        lines = generate_pattern(models.seeds[rhyme_sound], meter, models.rev_index, k=k, budget=budget)
+    except SearchLimitReached:
+        lines = None
+    return lines, budget.nodes
+
+
+class ParallelRhymeSearch:
+    '''
+    Searches every rhyme of a poem at the same time in a pool of worker
+    processes, each holding a read-only copy of the models. For each rhyme,
+    several rhyme sounds are raced against each other and the first one to
+    come back with enough lines wins, so a poem takes about as long as its
+    slowest rhyme.
+
+    Pass search (with a source bound) to generate_poem as rhyme_search.
+    '''
+    def __init__(self, text_sources, workers=None, race=2):
+        self.text_sources = text_sources
+        self.race = race
+        # forking hands the models to the workers without pickling them, and
+        # lets them share the pages until they're written to
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        self.executor = ProcessPoolExecutor(workers, mp_context=context,
+                                            initializer=_init_worker, initargs=(text_sources,))
+
+    def close(self, cancel=True):
+        '''
+        Shut the workers down. With cancel off, searches that are already
+        under way get to finish first
+        '''
+        self.executor.shutdown(wait=False, cancel_futures=cancel)
+
+    def search(self, source, groups, budget):
+        '''
+        groups is {rhyme: (meter, number of lines)}. Returns {rhyme: lines},
+        or None if some rhyme ran out of rhyme sounds to try
+        '''
+        models = self.text_sources[source]
+        # every rhyme tries the rhyme sounds that could work in its own random
+        # order
+        untried = {}
+        for p, (meter, k) in groups.items():
+            viable = models.rev_index.viable_rhymes(models.seeds, meter, k, budget)
+            untried[p] = random.sample(viable, len(viable))
+        running = {}
+        rhymes = {}
+
+        def submit(p):
+            if untried[p]:
+                meter, k = groups[p]
+                future = self.executor.submit(_find_pattern, source, untried[p].pop(), meter, k,
+                                              budget.remaining_time(), budget.remaining_nodes())
+                running[future] = p
+
+        try:
+            for p in groups:
+                for _ in range(self.race):
+                    submit(p)
+
+            while len(rhymes) < len(groups):
+                if any(p not in rhymes and p not in running.values() for p in groups):
+                    return None  # no poem found
+                done, _ = wait(running, timeout=budget.remaining_time(), return_when=FIRST_COMPLETED)
+                if not done:
+                    raise SearchLimitReached(DEADLINE)
+
+                for future in done:
+                    p = running.pop(future)
+                    lines, nodes = future.result()
+                    budget.expand(nodes)
+                    if p in rhymes:
+                        continue
+                    if lines is not None:
+                        rhymes[p] = lines
+                        # this rhyme's done, call off the rest of the race
+                        for other, q in list(running.items()):
+                            if q == p and other.cancel():
+                                del running[other]
+                    else:
+                        budget.retries += 1
+                        submit(p)
+
+            return rhymes
+        finally:
+            for future in running:
+                future.cancel()
+
+
+# each batch worker process's own copy of the PoemMaker
+_poem_maker = None
+
+
+def _init_batch_worker(poem_maker):
+    global _poem_maker
+    _poem_maker = poem_maker
+    # the parent's process pool doesn't survive the fork
+    _poem_maker.parallel = None
+
+
+def _generate_chunk(source, style, count, timeout, max_nodes):
+    return list(_poem_maker.generate_many(source, style, count, timeout=timeout, max_nodes=max_nodes))
+
+
+def generate_batch(poem_maker, source, style, n, workers, timeout=None, max_nodes=None, chunk_size=16):
+    '''
+    Generate n poems in a pool of worker processes, yielding each one as its
+    chunk comes back. Only a couple of chunks per worker are in flight at any
+    time, so memory stays flat however many poems are asked for.
+    '''
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(workers, mp_context=context,
+                             initializer=_init_batch_worker, initargs=(poem_maker,)) as executor:
+        remaining = n
+        running = set()
+        while remaining or running:
+            while remaining and len(running) < 2 * workers:
+                count = min(chunk_size, remaining)
+                running.add(executor.submit(_generate_chunk, source, style, count, timeout, max_nodes))
+                remaining -= count
+
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
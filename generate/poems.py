@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
+from collections import namedtuple
+from collections.abc import Mapping
+from functools import lru_cache
 import json
 import random
+import zlib
 
-from .syllables import count_syllables, fulfills_scansion, remaining_scheme, rhyme_fingerprint, valid_option
+from . import metrics
+from .index import SuccessorIndex
+from .lexicon import Lexicon
+from .limits import SearchBudget
+from .markov import MASK64, StateRandom, Successors
+from .scansion import as_meter, encode
+
+# everything generated from one text source. the poem styles take these as
+# keyword arguments and ignore whichever they don't need
+Models = namedtuple('Models', ['d', 'rev_d', 'seeds', 'lexicon', 'index', 'rev_index'])
 
 
 def get_file(filepath):
@@ -20,108 +33,208 @@ def get_file(filepath):
     return text.split('\n\n')
 
 
-def build_models(data):
-    '''
-    builds and returns a Markov dictionary, a reverse dictionary, and a set of
-    rhymes from the input text
-
-    data is a list of seed strings; each chunk of text may be unrelated (e.g.
-    lyrics from different songs)
-    '''
-    d = {}
-    reverse_d = {}
-    word_set = set()
+STRIP_CHARS = '.,()-?!":*;'
 
-    for text in data:
-        strip_chars = '.,()-?!":*;'
-        words = [word.strip(strip_chars).lower() for word in text.split() if word.strip(strip_chars)]
-        word_set.update(words)
 
-        for i, word in enumerate(words[:-1]):
-            if not word in d:
-                d[word] = []
-            d[word].append(words[i+1])
+def tokenize(text):
+    '''
+    Split text into normalized words, dropping any that are only punctuation
+    '''
+    words = (word.strip(STRIP_CHARS).lower() for word in text.split())
+    return [word for word in words if word]
 
 
-        # we are also gonna build a backwards markov, so we can start with a rhyme and
-        # fill in the lines from there
-        words.reverse()
+class ModelBuilder:
+    '''
+    Builds the models for a source a little at a time, so text can be
+    streamed in from any number of files without ever holding all of it
+
+    Feed it text with feed_line() and end_chunk(), or whole chunks with
+    feed_chunk(); the last word of one chunk is never connected to the first
+    word of the next. The forward and reverse counts, the lexicon and the
+    rhyme classes are all kept up to date as words arrive, so memory grows
+    with the size of the model rather than the size of the text.
+    '''
+    def __init__(self, lexicon=None):
+        self.counts = {}
+        self.reverse_counts = {}
+        self.lexicon = lexicon if lexicon is not None else Lexicon()
+        self.new_words = []
+        self.previous = None
+
+    def feed_words(self, words):
+        counts = self.counts
+        reverse_counts = self.reverse_counts
+        previous = self.previous
+        for word in words:
+            if word not in self.lexicon:
+                self.lexicon.add(word)
+                self.new_words.append(word)
+
+            if previous is not None:
+                following = counts.setdefault(previous, {})
+                following[word] = following.get(word, 0) + 1
+                # we are also gonna build a backwards markov, so we can start
+                # with a rhyme and fill in the lines from there
+                preceding = reverse_counts.setdefault(word, {})
+                preceding[previous] = preceding.get(previous, 0) + 1
+            previous = word
+        self.previous = previous
+
+    def feed_line(self, line):
+        self.feed_words(tokenize(line))
+
+    def end_chunk(self):
+        self.previous = None
+
+    def feed_chunk(self, text):
+        self.feed_line(text)
+        self.end_chunk()
+
+    def merge(self, other):
+        '''
+        Fold in another builder that was fed the text straight after this
+        one's, e.g. the next shard of a big file. Both must have ended on a
+        chunk break. The result is exactly what one builder fed all the text
+        would have made, down to the order of everything in it
+        '''
+        for counts, other_counts in ((self.counts, other.counts), (self.reverse_counts, other.reverse_counts)):
+            for word, other_following in other_counts.items():
+                following = counts.setdefault(word, {})
+                for option, count in other_following.items():
+                    following[option] = following.get(option, 0) + count
+
+        for word, entry in other.lexicon.entries.items():
+            if word not in self.lexicon:
+                self.lexicon.insert(word, entry)
+                self.new_words.append(word)
+
+    def build(self):
+        '''
+        Finish up and return the Models. The builder shouldn't be fed any
+        more after this
+        '''
+        # pop the counts as they're packed so there's only ever one copy
+        d = {}
+        for word in list(self.counts):
+            d[word] = Successors.from_counts(self.counts.pop(word))
+        reverse_d = {}
+        for word in list(self.reverse_counts):
+            reverse_d[word] = Successors.from_counts(self.reverse_counts.pop(word))
+
+        # we can seed off of words that have at least one matching rhyme. the
+        # lists are copied since the lexicon's keep growing if more text is
+        # added later
+        rhyme_seeds = {key: list(value) for key, value in self.lexicon.rhymes.items() if len(value) >= 2}
+
+        lexicon = self.lexicon
+        return Models(d, reverse_d, rhyme_seeds, lexicon, SuccessorIndex(d, lexicon), SuccessorIndex(reverse_d, lexicon))
 
-        for i, word in enumerate(words[:-1]):
-            if not word in reverse_d:
-                reverse_d[word] = []
-            reverse_d[word].append(words[i+1])
 
-    # we can seed off of words that have at least one matching rhyme
-    seeds = {}
-    for word in word_set:
-        rf = rhyme_fingerprint(word)
-        if rf is None:
-            continue
-        if not rf in seeds:
-            seeds[rf] = []
-        seeds[rf].append(word)
+def build_models(data):
+    '''
+    builds and returns a Markov dictionary, a reverse dictionary, a set of
+    rhymes, a lexicon of the vocabulary, and successor indexes over both
+    dictionaries from the input text
 
-    rhyme_seeds = {key:value for key, value in seeds.items() if len(value) >= 2}
+    the Markov dictionaries map each word to the Successors that followed (or
+    preceded) it, with how many times each one did
 
-    return d, reverse_d, rhyme_seeds
+    data is a list of seed strings; each chunk of text may be unrelated (e.g.
+    lyrics from different songs)
+    '''
+    builder = ModelBuilder()
+    for text in data:
+        builder.feed_chunk(text)
+    return builder.build()
 
 
-def find_scansion_with_backtrack(word, scansion_pattern, d):
-    if fulfills_scansion(word, scansion_pattern):
-        # success!
-        return [word]
-    if not valid_option(word, scansion_pattern):
-        return None
+def _salt(rng):
+    # a random generator of its own (i.e. a seeded request) gets each search
+    # state shuffled independently, see find_scansion_with_backtrack
+    return rng.getrandbits(64) if isinstance(rng, random.Random) else None
 
-    rest_pattern = remaining_scheme(word, scansion_pattern)
-    options = set([w for w in d.get(word, []) if valid_option(w, rest_pattern)])
-    if not options:
-        # failure!
-        return None
 
-    # otherwise, we need to keep looking
-    options = list(options)
-    random.shuffle(options)
-    for option in options:
-        rest = find_scansion_with_backtrack(option, rest_pattern, d)
-        if rest is not None:
-            # a good way to debug
-            #print(' '.join([word] + rest))
-            return [word] + rest
-
-    # whoops
-    return None
+def _state_rng(rng, salt, word, remaining):
+    if salt is None:
+        return rng
+    return StateRandom(salt ^ (zlib.crc32(word.encode('utf-8')) << 32) ^ (remaining * 0x9E3779B97F4A7C15 & MASK64))
 
 
-def find_syllables_with_backtrack(word, num_syllables, d):
-    word_syllables = count_syllables(word)
-    if word_syllables == num_syllables:
+def find_scansion_with_backtrack(word, scansion_pattern, index, budget=None, rng=random):
+    '''
+    Search backwards from word for a run of words that fills the scansion
+    pattern exactly, and return them (last word first), or None if there
+    isn't one
+
+    This is a depth first search kept on an explicit stack rather than the
+    call stack, so that long lines can't overflow it and the budget gets
+    checked at every node. rng makes the random choices, e.g. a seeded
+    random.Random
+
+    The dead ends remembered by the index skip whole subtrees, so with one
+    stream of random numbers the order the rest get tried in (and so the
+    line found) would depend on what earlier searches happened to learn.
+    When rng is a random.Random of its own, it's only used for one number
+    per search, and each state's successors are shuffled with a generator
+    made from that and the state. Every state is then tried in the same
+    order whatever's skipped, and the same rng always finds the same line
+    '''
+    if budget is None:
+        budget = SearchBudget()
+    salt = _salt(rng)
+    # the meters are packed into ints from here on, see scansion.py
+    scansion_pattern = as_meter(scansion_pattern)
+    lexicon = index.lexicon
+    dead = index.dead_meter
+
+    if (word, scansion_pattern) in dead:
+        budget.memo_hits += 1
+        return None
+    if lexicon.fulfills_scansion(word, scansion_pattern):
         # success!
         return [word]
-    if word_syllables > num_syllables:
+    if not lexicon.valid_option(word, scansion_pattern):
         return None
 
-    remaining_syllables = num_syllables - word_syllables
-    options = set([w for w in d.get(word, []) if count_syllables(w) <= remaining_syllables])
-    if not options:
-        # failure!
-        return None
-
-    options = list(options)
-    random.shuffle(options)
-    for option in options:
-        rest = find_syllables_with_backtrack(option, remaining_syllables, d)
-        if rest is not None:
-            return [word] + rest
+    # otherwise, we need to keep looking. only the successors that fit the end
+    # of the rest of the line are worth trying, likelier ones first
+    budget.expand()
+    rest_pattern = lexicon.remaining_scheme(word, scansion_pattern)
+    stack = [(word, scansion_pattern, rest_pattern,
+              index.fitting_meter(word, rest_pattern).shuffled(_state_rng(rng, salt, word, rest_pattern)))]
+
+    while stack:
+        word, scansion_pattern, rest_pattern, options = stack[-1]
+        for option in options:
+            if (option, rest_pattern) in dead:
+                budget.memo_hits += 1
+                continue
+            if lexicon.fulfills_scansion(option, rest_pattern):
+                # success!
+                # a good way to debug
+                #print(' '.join([w for w, *_ in stack] + [option]))
+                return [w for w, *_ in stack] + [option]
+            budget.expand()
+            option_rest = lexicon.remaining_scheme(option, rest_pattern)
+            stack.append((option, rest_pattern, option_rest,
+                          index.fitting_meter(option, option_rest).shuffled(
+                              _state_rng(rng, salt, option, option_rest))))
+            break
+        else:
+            # whoops. nothing finishes the line from here, so don't come back
+            stack.pop()
+            dead.add((word, scansion_pattern))
+            budget.dead_ends += 1
 
     return None
 
 
-def generate_pattern(seed_words, pattern, d, k=2):
+def generate_pattern(seed_words, pattern, index, k=2, budget=None, rng=random):
+    pattern = as_meter(pattern)
     lines = []
     for seed in seed_words:
-        line = find_scansion_with_backtrack(seed, pattern, d)
+        line = find_scansion_with_backtrack(seed, pattern, index, budget, rng)
         if line is not None:
             lines.append(' '.join(line[::-1]))
         if len(lines) == k:
@@ -130,130 +243,231 @@ def generate_pattern(seed_words, pattern, d, k=2):
     return None
 
 
-def generate_syllables(num_syllables, d, preseed=None):
-    line = None
-    while line is None:
-        if preseed is None:
-            seed = random.choice(list(d.keys()))
-        else:
-            seed = random.choice(d.get(preseed, list(d.keys())))
-        line = find_syllables_with_backtrack(seed, num_syllables, d)
+def generate_syllables(num_syllables, index, preseed=None, budget=None, rng=random):
+    '''
+    A line of words following the Markov dictionary with exactly
+    num_syllables syllables, starting with a word that can follow preseed if
+    any can, or None if the dictionary has no such line at all
+
+    Every word is picked from the ones the index knows can still finish the
+    line (see SuccessorIndex.syllable_starts), so this is one random walk
+    with a node per word and never backtracks or retries
+    '''
+    if budget is None:
+        budget = SearchBudget()
+    lexicon = index.lexicon
+
+    seed = None
+    if preseed is not None:
+        options = index.reaching_syllables(preseed, num_syllables)
+        if options:
+            seed = options.sample(rng)
+    if seed is None:
+        starts = index.syllable_starts(num_syllables)
+        if not starts:
+            return None
+        seed = rng.choice(starts)
+
+    line = [seed]
+    remaining = num_syllables - lexicon.syllables(seed)
+    budget.expand()
+    while remaining:
+        word = index.reaching_syllables(line[-1], remaining).sample(rng)
+        line.append(word)
+        remaining -= lexicon.syllables(word)
+        budget.expand()
     return ' '.join(line)
 
 
-def generate_haiku(d, **kwargs):
-    haiku = []
+def generate_haiku(d, lexicon=None, index=None, budget=None, rng=random, **kwargs):
+    if index is None:
+        index = SuccessorIndex(d, lexicon)
 
-    haiku.append(generate_syllables(5, d))
-    haiku.append(generate_syllables(7, d, preseed=haiku[-1].split()[-1]))
-    haiku.append(generate_syllables(5, d, preseed=haiku[-1].split()[-1]))
+    haiku = []
+    for num_syllables in (5, 7, 5):
+        with metrics.timed('stage_seconds', stage='line'):
+            line = generate_syllables(num_syllables, index, preseed=haiku[-1].split()[-1] if haiku else None,
+                                      budget=budget, rng=rng)
+        if line is None:
+            return []
+        haiku.append(line)
 
     return haiku
 
 
-def generate_poem(pattern, definitions, rev_d, seeds, **kwargs):
+def find_rhyme(seeds, meter, k, rev_index, budget=None, rng=random):
     '''
-    Build your own poem
+    Try rhyme sounds at random until one of them gives k lines that fit the
+    meter, and return those lines, or None if none of them do
+
+    Only rhyme sounds that can possibly give k lines are tried, so this
+    rarely needs more than one go. Each rhyme sound that fails anyway counts
+    as a retry on the budget
+    '''
+    if budget is None:
+        budget = SearchBudget()
+
+    with metrics.timed('stage_seconds', stage='viable_rhymes'):
+        viable = rev_index.viable_rhymes(seeds, meter, k, budget)
+    for rhyme_sound in rng.sample(viable, len(viable)):
+        budget.check()
+        with metrics.timed('stage_seconds', stage='rhyme'):
+            rhyme = generate_pattern(seeds[rhyme_sound], meter, rev_index, k=k, budget=budget, rng=rng)
+        if rhyme is not None:
+            return rhyme
+        budget.retries += 1
+    return None
+
+
+class PoemPlan:
+    '''
+    A rhyming poem form compiled once, so that generating a poem goes
+    straight to finding lines
 
     pattern: a string describing a rhyme pattern e.g., ABABCC. Use a space
         to indicate line breaks
     definitions: a dictionary with keys corresponding to each rhyme line e.g.
         'A' and values describing the syllable pattern e.g. '01101101'
-    '''
 
-    if not all(p in definitions for p in pattern if p != ' '):
-        raise ValueError('Must define all rhymes used')
-
-    # Generate the appropriate number of matching lines for each pattern
-    distinct_rhymes = set(pattern)
-    if ' ' in distinct_rhymes:
-        distinct_rhymes.remove(' ')
-
-    rhymes = {}
-
-    for p in distinct_rhymes:
-        tried_rhymes = set()
-        rhyme = None
-        while rhyme is None and len(tried_rhymes) < len(seeds):
-            rhyme_sound = random.choice(list(seeds.keys()))
-            tried_rhymes.add(rhyme_sound)
-            rhyme = generate_pattern(seeds[rhyme_sound], definitions[p], rev_d, k=pattern.count(p))
-        if len(tried_rhymes) == len(seeds) and rhyme is None:
-            return ''  # no poem found
-        rhymes[p] = rhyme
-
-    # Assemble them
-    output = []
-    line_output = []
-
-    for rhyme in pattern:
-        if rhyme == ' ':
-            output.append(' '.join(line_output))
-            line_output = []
+    The meters are packed, the number of lines each rhyme needs is counted,
+    and the layout of the poem is worked out up front. The rhyme sounds that
+    can give each rhyme enough lines are found once per source (the source's
+    SuccessorIndex remembers them), and a poem that can't be written from a
+    source is given up on before any lines are searched for.
+
+    Call a plan like any other poem style.
+    '''
+    def __init__(self, pattern, definitions):
+        if not isinstance(pattern, str) or not isinstance(definitions, Mapping):
+            raise ValueError('A form is a pattern string and a dictionary of meters')
+        rhymes = [p for p in pattern if p != ' ']
+        if not rhymes:
+            raise ValueError('Pattern has no lines')
+        if not all(p in definitions for p in rhymes):
+            raise ValueError('Must define all rhymes used')
+
+        # {rhyme: (packed meter, number of lines)}, in the order the rhymes
+        # first turn up
+        self.groups = {}
+        for p in dict.fromkeys(rhymes):
+            meter = definitions[p]
+            if not isinstance(meter, str) or not meter or set(meter) - set('01x'):
+                raise ValueError(f'The meter for {p} must be made of 0, 1 and x')
+            self.groups[p] = (encode(meter), rhymes.count(p))
+        self.pattern = pattern
+        self.definitions = {p: definitions[p] for p in self.groups}
+        # the rhymes making up each line of the poem
+        self.lines = pattern.split(' ')
+
+    def __repr__(self):
+        return f'PoemPlan({self.pattern!r}, {self.definitions!r})'
+
+    def viable(self, seeds, rev_index, budget=None):
+        '''
+        {rhyme: the rhyme sounds in seeds that can give it enough lines}
+        '''
+        return {p: rev_index.viable_rhymes(seeds, meter, k, budget) for p, (meter, k) in self.groups.items()}
+
+    def __call__(self, rev_d, seeds, lexicon=None, rev_index=None, budget=None, rhyme_search=None, rng=random,
+                 **kwargs):
+        '''
+        budget: an optional SearchBudget; SearchLimitReached is raised if the
+            search runs past it
+        rhyme_search: optionally, something else to find the lines for every
+            rhyme at once, e.g. ParallelRhymeSearch. It's called with {rhyme:
+            (meter, number of lines)} and the budget, and returns {rhyme:
+            lines}, or None if any rhyme couldn't be found
+        rng: what makes the random choices, e.g. a seeded random.Random. The
+            random module by default
+        '''
+        if rev_index is None:
+            rev_index = SuccessorIndex(rev_d, lexicon)
+        if budget is None:
+            budget = SearchBudget()
+
+        with metrics.timed('stage_seconds', stage='viable_rhymes'):
+            viable = self.viable(seeds, rev_index, budget)
+        if not all(viable.values()):
+            return []  # no poem to be found
+
+        # Generate the appropriate number of matching lines for each pattern
+        if rhyme_search is not None:
+            with metrics.timed('stage_seconds', stage='rhyme_search'):
+                rhymes = rhyme_search(self.groups, budget)
+            if rhymes is None:
+                return []  # no poem found
         else:
-            line_output.append(rhymes[rhyme].pop())
-
-    output.append(' '.join(line_output))
-
-    return output
-
-
-def generate_raven_verse(rev_d, seeds, **kwargs):
-    segment = '10101010'
-    segment_short  = '1010101'
-
-    return generate_poem(
-        'AA BC DD DC EC C',
-        {
-            'A': segment,
-            'B': segment,
-            'C': segment_short,
-            'D': segment,
-            'E': segment,
-        },
-        rev_d,
-        seeds,
-        **kwargs)
-
-
-def generate_limerick(rev_d, seeds, **kwargs):
-    return generate_poem(
-        'A A B B A',
-        {
-            'A': '01001001',
-            'B': '01001',
-        },
-        rev_d,
-        seeds,
-        **kwargs)
-
-
-def generate_sonnet(rev_d, seeds, **kwargs):
-    i_p = '01' * 5  # iambic pentameter
-
-    return generate_poem(
-        'A B A B  C D C D  E F E F  G G',
-        {
-            'A': i_p,
-            'B': i_p,
-            'C': i_p,
-            'D': i_p,
-            'E': i_p,
-            'F': i_p,
-            'G': i_p,
-        },
-        rev_d,
-        seeds,
-        **kwargs)
-
-
-def generate_common_meter(rev_d, seeds, **kwargs):
-    return generate_poem(
-        'A B A B',
-        {
-            'A': '01' * 4,
-            'B': '01' * 3,
-        },
-        rev_d,
-        seeds,
-        **kwargs)
+            rhymes = {}
+            for p, (meter, k) in self.groups.items():
+                rhyme = find_rhyme(seeds, meter, k, rev_index, budget, rng)
+                if rhyme is None:
+                    return []  # no poem found
+                rhymes[p] = rhyme
+
+        # Assemble them
+        return [' '.join(rhymes[rhyme].pop() for rhyme in line) for line in self.lines]
+
+
+@lru_cache(maxsize=256)
+def _compile_form(pattern, definitions):
+    return PoemPlan(pattern, dict(definitions))
+
+
+def compile_form(pattern, definitions):
+    '''
+    The PoemPlan for a form, compiled the first time it's asked for and then
+    remembered by its definition, so forms made up on the fly are as quick
+    as the built in ones from their second poem on
+    '''
+    if not isinstance(definitions, Mapping):
+        raise ValueError('A form is a pattern string and a dictionary of meters')
+    try:
+        return _compile_form(pattern, tuple(sorted(definitions.items())))
+    except TypeError:
+        # something unhashable or unsortable, which PoemPlan will explain
+        return PoemPlan(pattern, definitions)
+
+
+def generate_poem(pattern, definitions, rev_d, seeds, lexicon=None, rev_index=None, budget=None,
+                  rhyme_search=None, rng=random, **kwargs):
+    '''
+    Build your own poem
+
+    pattern and definitions are as for PoemPlan, and the rest as for calling
+    one. The form is compiled once and remembered (see compile_form)
+    '''
+    plan = compile_form(pattern, definitions)
+    return plan(rev_d, seeds, lexicon=lexicon, rev_index=rev_index, budget=budget, rhyme_search=rhyme_search,
+                rng=rng)
+
+
+# the built in forms. each raven verse rhyme is half a line of trochaic
+# octameter, and the C halves are a syllable short
+generate_raven_verse = compile_form(
+    'AA BC DD DC EC C',
+    {
+        'A': '10101010',
+        'B': '10101010',
+        'C': '1010101',
+        'D': '10101010',
+        'E': '10101010',
+    })
+
+generate_limerick = compile_form(
+    'A A B B A',
+    {
+        'A': '01001001',
+        'B': '01001',
+    })
+
+# iambic pentameter throughout
+generate_sonnet = compile_form(
+    'A B A B  C D C D  E F E F  G G',
+    {rhyme: '01' * 5 for rhyme in 'ABCDEFG'})
+
+generate_common_meter = compile_form(
+    'A B A B',
+    {
+        'A': '01' * 4,
+        'B': '01' * 3,
+    })
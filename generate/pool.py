@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+from itertools import cycle
+import logging
+import queue
+import threading
+import time
+
+from .generator import new_seed
+
+# how long to leave a (source, style) alone after it fails, doubling on each
+# failure in a row up to the max, so hopeless pairs don't hog the workers
+FAILURE_BACKOFF = 1.0
+MAX_FAILURE_BACKOFF = 300.0
+
+
+class PoemPool:
+    '''
+    Keeps a few ready-made poems for every (source, style) pair, topped up by
+    background threads, so a request can usually be answered straight away
+    instead of waiting on a search. When a pair's pool is empty, get() falls
+    back to generating a poem on the spot.
+
+    depth: how many poems to keep ready per (source, style)
+    workers: how many background threads refill the pools
+    refill_interval: seconds each worker rests between poems, to cap how much
+        CPU refilling takes from requests
+    timeout, max_nodes: limits on each background and fallback search
+
+    Every poem is generated with a seed of its own, kept on the poem, so
+    any of them can be made again (and linked to) later.
+    '''
+    def __init__(self, poem_maker, depth=4, workers=1, refill_interval=0.0, timeout=None, max_nodes=None):
+        self.poem_maker = poem_maker
+        self.depth = depth
+        self.workers = workers
+        self.refill_interval = refill_interval
+        self.timeout = timeout
+        self.max_nodes = max_nodes
+
+        self.pools = {}
+        self.counts = {}
+        for source in poem_maker.text_sources:
+            for style in poem_maker.poem_styles:
+                self.pools[source, style] = queue.Queue(maxsize=depth)
+                self.counts[source, style] = {'hits': 0, 'misses': 0, 'generated': 0, 'failed': 0}
+
+        self._turns = cycle(list(self.pools))
+        self._backoff = {}
+        self._retry_at = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._refill, name=f'poem-pool-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _count(self, key, stat):
+        with self._lock:
+            self.counts[key][stat] += 1
+
+    def get(self, source, style):
+        '''
+        Return a ready poem if there is one, or generate one now if not
+        '''
+        key = (source, style)
+        if key in self.pools:
+            try:
+                poem = self.pools[key].get_nowait()
+                self._count(key, 'hits')
+                return poem
+            except queue.Empty:
+                self._count(key, 'misses')
+        return self.poem_maker.generate(source, style, timeout=self.timeout, max_nodes=self.max_nodes,
+                                        seed=new_seed())
+
+    def _next_to_fill(self):
+        '''
+        Take turns between the pools that aren't full, so one that keeps
+        failing can't starve the rest
+        '''
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.pools)):
+                key = next(self._turns)
+                if not self.pools[key].full() and self._retry_at.get(key, 0) <= now:
+                    return key
+        return None
+
+    def _refill(self):
+        while not self._stop.is_set():
+            key = self._next_to_fill()
+            if key is None:
+                # everything's topped up or backing off. check back in a bit
+                self._stop.wait(max(self.refill_interval, 0.1))
+                continue
+
+            try:
+                poem = self.poem_maker.generate(*key, timeout=self.timeout, max_nodes=self.max_nodes, seed=new_seed())
+            except Exception:
+                logging.exception('Failed to generate %s for the pool', key)
+                poem = None
+
+            if poem:
+                with self._lock:
+                    self._backoff.pop(key, None)
+                    self._retry_at.pop(key, None)
+                try:
+                    self.pools[key].put_nowait(poem)
+                    self._count(key, 'generated')
+                except queue.Full:
+                    # another worker got there first
+                    pass
+            else:
+                self._count(key, 'failed')
+                with self._lock:
+                    backoff = min(self._backoff.get(key, FAILURE_BACKOFF / 2) * 2, MAX_FAILURE_BACKOFF)
+                    self._backoff[key] = backoff
+                    self._retry_at[key] = time.monotonic() + backoff
+
+            if self.refill_interval:
+                self._stop.wait(self.refill_interval)
+
+    def stats(self):
+        '''
+        {(source, style): {'ready': poems waiting, 'hits': ..., 'misses': ...,
+        'generated': ..., 'failed': ...}}
+        '''
+        with self._lock:
+            return {key: dict(counts, ready=self.pools[key].qsize()) for key, counts in self.counts.items()}
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import pickle
+import time
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pronunciations.idx')
+# bump this whenever the packed entry layout changes
+INDEX_FORMAT = 1
+
+STRESS_MARKS = {'1': '1', '2': 'x', '0': '0'}
+
+
+def pack_pronunciations(pronunciations):
+    '''
+    Pack the parts of a word's CMU pronunciations that we actually use into a
+    single string: the stress pattern of every pronunciation, then the rhyme
+    tail (the last stressed vowel onwards) of the first pronunciation
+
+    e.g. [['P', 'AY1', 'TH', 'AA0', 'N']] => '10|AY1 TH AA0 N'
+    '''
+    stresses = []
+    for p in pronunciations:
+        stresses.append(''.join(STRESS_MARKS[sound[-1]] for sound in p if sound[-1] in STRESS_MARKS))
+
+    tail = []
+    for sound in pronunciations[0][::-1]:
+        tail.append(sound)
+        if '1' in sound or '2' in sound:
+            break
+
+    return ','.join(stresses) + '|' + ' '.join(tail[::-1])
+
+
+def compile_index():
+    '''
+    Build the packed index from the NLTK CMU pronouncing dictionary. This is
+    the slow part, so it's only done when there's no precompiled index
+    '''
+    from nltk.corpus import cmudict
+    return {word: pack_pronunciations(p) for word, p in cmudict.dict().items()}
+
+
+def save_index(entries, path=INDEX_PATH):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((INDEX_FORMAT, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_index(path=INDEX_PATH):
+    '''
+    Load a precompiled index, or return None if there isn't a usable one
+    '''
+    try:
+        with open(path, 'rb') as f:
+            index_format, entries = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        logging.warning('Ignoring unreadable pronunciation index %s', path, exc_info=True)
+        return None
+    if index_format != INDEX_FORMAT:
+        return None
+    return entries
+
+
+class PronunciationIndex:
+    '''
+    The stress patterns, syllable counts and rhyme tails of every word in the
+    CMU pronouncing dictionary, packed into one short string per word
+
+    Nothing is loaded until the first lookup. The precompiled index is read
+    from disk if it's there; otherwise it's compiled from cmudict and saved
+    for next time.
+    '''
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            entries = load_index(self.path)
+            if entries is None:
+                entries = compile_index()
+                try:
+                    save_index(entries, self.path)
+                except OSError:
+                    logging.warning('Could not save pronunciation index to %s', self.path, exc_info=True)
+            self._entries = entries
+        return self._entries
+
+    def __contains__(self, word):
+        return word in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stresses(self, word):
+        '''
+        The stress pattern of each pronunciation of the word, as strings of 0
+        (unstressed), 1 (primary stress) and x (secondary stress)
+        '''
+        return self.entries[word].partition('|')[0].split(',')
+
+    def syllables(self, word):
+        '''
+        The number of syllables in the first pronunciation of the word
+        '''
+        return len(self.stresses(word)[0])
+
+    def rhyme_tail(self, word):
+        '''
+        The sounds of the first pronunciation of the word, starting from the
+        last stressed syllable
+        '''
+        return tuple(self.entries[word].partition('|')[2].split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompile the pronunciation index from cmudict')
+    parser.add_argument('path', nargs='?', default=INDEX_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    entries = compile_index()
+    save_index(entries, args.path)
+    print(f'Compiled {len(entries)} words to {args.path} in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+'''
+Syllable fingerprints and meters packed into ints, so the searches can match
+them with a few bitwise operations instead of comparing strings a character
+at a time
+
+Each syllable takes two bits: a "care" bit, set if the syllable must be
+stressed or unstressed, and a stress bit, set if it must be stressed. So '0'
+is 0b10, '1' is 0b11 and 'x' (either) is 0b00. The last syllable goes in the
+lowest bits, so cutting syllables off the end of a meter is a right shift,
+and a 1 bit above the first syllable marks how long it is.
+
+e.g. '01x' is 0b1_10_11_00
+'''
+
+from functools import lru_cache
+
+CODES = {'0': 0b10, '1': 0b11, 'x': 0b00}
+SYMBOLS = {code: symbol for symbol, code in CODES.items()}
+
+# the stress and care bits of every syllable of anything up to WIDTH
+# syllables long, which is far more than any line needs. longer meters (custom
+# forms can ask for anything) get masks made to fit
+WIDTH = 128
+STRESS_BITS = int('01' * WIDTH, 2)
+CARE_BITS = STRESS_BITS << 1
+
+EMPTY = 1
+
+
+def encode(fp):
+    '''
+    Pack a fingerprint or meter string of 0, 1 and x
+    '''
+    packed = EMPTY
+    for symbol in fp:
+        packed = packed << 2 | CODES[symbol]
+    return packed
+
+
+def decode(packed):
+    symbols = []
+    while packed != EMPTY:
+        symbols.append(SYMBOLS[packed & 0b11])
+        packed >>= 2
+    return ''.join(reversed(symbols))
+
+
+def as_meter(meter):
+    '''
+    Pack meter if it's still a string
+    '''
+    return encode(meter) if isinstance(meter, str) else meter
+
+
+def length(packed):
+    return (packed.bit_length() - 1) >> 1
+
+
+@lru_cache(maxsize=64)
+def _wide_bits(syllables):
+    stress = int('01' * syllables, 2)
+    return stress, stress << 1
+
+
+def _compatible(a, b, syllables):
+    # a syllable only clashes when both sides care and the stresses differ
+    if syllables > WIDTH:
+        stress, care = _wide_bits(syllables)
+        return not ((a ^ b) & ((a & b & care) >> 1) & stress)
+    return not ((a ^ b) & ((a & b & CARE_BITS) >> 1) & STRESS_BITS)
+
+
+def matches(fp, meter):
+    '''
+    True if the fingerprint fills the meter exactly
+    '''
+    bits = meter.bit_length()
+    return fp.bit_length() == bits and _compatible(fp, meter, (bits - 1) >> 1)
+
+
+def fits_end(fp, meter):
+    '''
+    True if the fingerprint fits at the end of the meter
+    '''
+    bits = fp.bit_length() - 1
+    if bits == 0:
+        # like the string version, a word with no syllables only fits an
+        # empty meter
+        return meter == EMPTY
+    if bits > meter.bit_length() - 1:
+        return False
+    mask = (1 << bits) - 1
+    return _compatible(fp & mask, meter & mask, bits >> 1)
+
+
+def drop_end(fp, meter):
+    '''
+    What's left of the meter once the fingerprint's syllables are cut off its
+    end
+    '''
+    if fp == EMPTY:
+        return EMPTY
+    return meter >> (fp.bit_length() - 1)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import threading
+import time
+
+from .limits import CANCELLED, DEADLINE, PoemResult
+
+# how much longer than its timeout a request waits on a search before giving
+# up on it, since the search only notices the deadline between nodes
+GRACE = 1.0
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PoemService:
+    '''
+    Runs poem requests on a bounded pool of threads, so a web server's own
+    threads only ever wait on them and a flood of requests can't pile up
+    searches without end
+
+    workers: how many requests are searched at once
+    max_pending: how many requests can be running or waiting at once. More
+        than that and new requests raise QueueFull straight away
+    '''
+    def __init__(self, poem_maker, workers=4, max_pending=16):
+        self.poem_maker = poem_maker
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='poem-service')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, search, timeout):
+        '''
+        Run search(timeout, cancel) on the pool and wait for its list of
+        PoemResults. The timeout covers the whole request, time spent waiting
+        for a thread included. A request that runs past it is cancelled, so
+        it stops taking up a thread, and comes back as a single DEADLINE
+        result
+        '''
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull()
+
+        cancel = threading.Event()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        def run():
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            return search(remaining, cancel)
+
+        try:
+            future = self.executor.submit(run)
+        except BaseException:
+            self._slots.release()
+            raise
+        # the slot is only free again once the search has actually stopped
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout + GRACE if timeout is not None else None)
+        except TimeoutError:
+            return [PoemResult('', DEADLINE)]
+        finally:
+            if not future.done():
+                cancel.set()
+                future.cancel()
+
+    def _search_many(self, make_poem, count, seed, timeout, cancel):
+        # seeds each poem on its own, so poem i of a seed is the same however
+        # many are asked for
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        poems = []
+        for i in range(count):
+            remaining = max(deadline - time.monotonic(), 0) if deadline is not None else None
+            poem = make_poem(remaining, None if seed is None else f'{seed}:{i}', cancel)
+            poems.append(poem)
+            if poem.status == CANCELLED:
+                break
+        return poems
+
+    def generate(self, source, style, count=1, seed=None, timeout=None, max_nodes=None):
+        '''
+        count poems from one of the PoemMaker's sources, as a list of
+        PoemResults. max_nodes applies to each poem and timeout to the lot
+        '''
+        def make_poem(remaining, poem_seed, cancel):
+            return self.poem_maker.generate(source, style, timeout=remaining, max_nodes=max_nodes,
+                                            seed=poem_seed, cancel=cancel)
+        return self._run(lambda remaining, cancel: self._search_many(make_poem, count, seed, remaining, cancel),
+                         timeout)
+
+    def generate_custom(self, source_text, style, count=1, seed=None, timeout=None, max_nodes=None):
+        '''
+        Like generate, but from the given text
+        '''
+        def make_poem(remaining, poem_seed, cancel):
+            return self.poem_maker.generate_custom(source_text, style, timeout=remaining, max_nodes=max_nodes,
+                                                   seed=poem_seed, cancel=cancel)
+        return self._run(lambda remaining, cancel: self._search_many(make_poem, count, seed, remaining, cancel),
+                         timeout)
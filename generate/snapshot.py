@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+import zlib
+
+from . import __version__
+from .ingest import build_source, source_files
+
+# bump this whenever the shape of the pickled models changes, so stale
+# snapshots get rebuilt instead of loaded
+SNAPSHOT_FORMAT = 6
+MAGIC = b'PYAMBIC-SNAPSHOT'
+
+
+def source_hash(filepath):
+    '''
+    Hash the contents of a source file or directory, a block at a time so big
+    corpora don't have to fit in memory
+    '''
+    h = hashlib.sha256()
+    for path in source_files(filepath):
+        # so renaming or moving text between files counts as a change
+        h.update(os.path.relpath(path, filepath).encode() + b'\0')
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def snapshot_path(filepath):
+    '''
+    Snapshots live next to their source as hidden files, which setup() skips
+    '''
+    folder, filename = os.path.split(filepath)
+    return os.path.join(folder, f'.{filename}.snapshot')
+
+
+def snapshot_key(filepath):
+    '''
+    A snapshot is only valid for the exact source contents, snapshot format,
+    and library version it was built from
+    '''
+    return f'{SNAPSHOT_FORMAT}:{__version__}:{source_hash(filepath)}'
+
+
+def dump_models(models, f, key):
+    f.write(MAGIC + b'\n')
+    f.write(key.encode() + b'\n')
+    f.write(zlib.compress(pickle.dumps(models, protocol=pickle.HIGHEST_PROTOCOL)))
+
+
+def read_models(f, key):
+    '''
+    Read models written by dump_models, or return None if they were written
+    under a different key
+    '''
+    if f.readline().rstrip(b'\n') != MAGIC:
+        return None
+    if f.readline().rstrip(b'\n').decode() != key:
+        return None
+    return pickle.loads(zlib.decompress(f.read()))
+
+
+def write_models(models, path, key):
+    # write somewhere else first so a half-written file is never loaded, even
+    # with other threads or processes writing the same models
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            dump_models(models, f, key)
+        os.replace(tmp_path, path)
+    except OSError:
+        # e.g. the disk filled up. don't leave half a file behind
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_models(path, key):
+    '''
+    Load models saved with write_models, or return None if there aren't any
+    or they're out of date
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return read_models(f, key)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, ImportError, AttributeError, zlib.error, pickle.UnpicklingError):
+        # ImportError and AttributeError mean it was pickled by code laid out
+        # differently from ours
+        logging.warning('Ignoring unreadable models in %s', path, exc_info=True)
+        return None
+
+
+def save_snapshot(models, filepath, key=None):
+    if key is None:
+        key = snapshot_key(filepath)
+    write_models(models, snapshot_path(filepath), key)
+
+
+def load_snapshot(filepath, key=None):
+    '''
+    Load the snapshot for a source file, or return None if there isn't one
+    or it's out of date
+    '''
+    if key is None:
+        key = snapshot_key(filepath)
+    return load_models(snapshot_path(filepath), key)
+
+
+def load_or_build(filepath):
+    '''
+    Return the models for a source file or directory from its snapshot if
+    it's still valid, otherwise build them and save a fresh snapshot for next
+    time
+    '''
+    key = snapshot_key(filepath)
+    models = load_snapshot(filepath, key)
+    if models is not None:
+        return models
+
+    models = build_source(filepath)
+    try:
+        save_snapshot(models, filepath, key)
+    except OSError:
+        # a read-only data folder shouldn't stop us from serving poems
+        logging.warning('Could not save snapshot for %s', filepath, exc_info=True)
+    return models
+
+
+def main():
+    from .generator import DATA_FOLDER
+
+    parser = argparse.ArgumentParser(description='Prebuild model snapshots for every source in a data folder')
+    parser.add_argument('data_folder', nargs='?', default=DATA_FOLDER)
+    args = parser.parse_args()
+
+    for filename in sorted(os.listdir(args.data_folder)):
+        if filename.startswith('.'):
+            continue
+        filepath = os.path.join(args.data_folder, filename)
+
+        start = time.perf_counter()
+        models = build_source(filepath)
+        build_time = time.perf_counter() - start
+        save_snapshot(models, filepath)
+
+        start = time.perf_counter()
+        load_snapshot(filepath)
+        load_time = time.perf_counter() - start
+
+        size = os.path.getsize(snapshot_path(filepath))
+        print(f'{filename}: built in {build_time:.3f}s, loads in {load_time:.3f}s ({size / 1024:.0f} KiB)')
+
+
+if __name__ == '__main__':
+    main()
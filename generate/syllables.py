@@ -3,10 +3,13 @@
 from functools import wraps
 import logging
 import re
+import time
 
-from nltk.corpus import cmudict
-from num2words import num2words
-d = cmudict.dict()
+from . import metrics
+from .pronunciation import PronunciationIndex
+
+# loaded lazily on the first lookup, so importing this module stays cheap
+pronunciations = PronunciationIndex()
 
 
 def clean_word(s):
@@ -38,6 +41,7 @@ def count_vowel_groups(word):
 
     # special case for all numbers
     if all(letter in digits for letter in word):
+        from num2words import num2words
         return count_syllables(num2words(word))
 
     # special case for no vowels - maybe it's an acronym. we can say each
@@ -88,15 +92,12 @@ def count_syllables(word):
     if '.' in word:
         return sum([count_syllables(w) for w in word.split('.')]) + len(word.split('.')) - 1
 
-    if not word in d:
+    if not word in pronunciations:
+        metrics.inc('pronunciation_misses_total')
         return count_vowel_groups(word)
 
-    sounds = d[word][0]  # just pick the first pronunciation if there are multiple
-    syllables = 0
-    for s in sounds:
-        if '0' in s or '1' in s or '2' in s:
-            syllables += 1
-    return syllables
+    # just pick the first pronunciation if there are multiple
+    return pronunciations.syllables(word)
 
 
 def get_syllable_stress(word):
@@ -110,26 +111,16 @@ def get_syllable_stress(word):
 
     # special case for e.g. singin', prayin'. a common transcription in written lyrics
     # does not work on goin' as goin is apparently a word. hope the apostrophe is there
-    if ends_with_ing or (not word in d and word.endswith('in') and word + 'g' in d):
+    if ends_with_ing or (not word in pronunciations and word.endswith('in') and word + 'g' in pronunciations):
         word = word + 'g'
 
-    if not word in d:
+    if not word in pronunciations:
         syllables = count_syllables(word)
         # return '000' and '111' so it fingerprints to 'xxx'
         stresses_options.add('0'*syllables)
         stresses_options.add('1'*syllables)
     else:
-        pronunciations = d[word]
-        for p in pronunciations:
-            stress = []
-            for syllable in p:
-                if '1' in syllable:
-                    stress.append('1')
-                if '2' in syllable:  # secondary stress
-                    stress.append('x')
-                if '0' in syllable:
-                    stress.append('0')
-            stresses_options.add(''.join(stress))
+        stresses_options.update(pronunciations.stresses(word))
 
     return stresses_options
 
@@ -146,6 +137,15 @@ def syllable_fingerprint(word):
     e.g. python => 10
     pronunciation => 0x010
     """
+    if metrics.enabled:
+        start = time.perf_counter()
+        fp = _syllable_fingerprint(word)
+        metrics.observe('syllable_fingerprint_seconds', time.perf_counter() - start)
+        return fp
+    return _syllable_fingerprint(word)
+
+
+def _syllable_fingerprint(word):
     stresses = get_syllable_stress(word)
     if not stresses:
         raise ValueError(f'Found no options for word {word}')
@@ -176,24 +176,13 @@ def rhyme_fingerprint(word):
     words that rhyme
     """
     word = word.lower()
-    if not word in d:
+    if not word in pronunciations:
         return None
 
     # for now, just grab the last vowel sound and whatever occurs after it
     # then we can worry about slant rhymes and multisyllable rhymes and shit later
-    # and also multiple pronunciations
-    sounds = d[word][0]
-    fingerprint = []
-
-    # there's probably a way to do this with list.find() or something
-    for sound in sounds[::-1]:
-        fingerprint.append(sound)
-        # digits designate emphasis in syllables; we've found a syllable,
-        # more or less
-        if '1' in sound or '2' in sound:
-            break
-        
-    return tuple(fingerprint[::-1])
+    # and also multiple pronunciations. the index has already worked that out
+    return pronunciations.rhyme_tail(word)
 
 
 def syllables_match(a, b):
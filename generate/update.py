@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+from collections import ChainMap
+import locale
+import logging
+import os
+import threading
+
+from .ingest import source_files, source_name
+from .markov import Successors, successors
+from .poems import ModelBuilder
+
+# how many layers of updates a dictionary can pile up before they're squashed
+# into one, so lookups don't get slower and slower
+MAX_LAYERS = 8
+
+# how many bytes from just before where we stopped reading a file to keep, to
+# tell a file that's been added to from one that's been edited
+TAIL_SIZE = 4096
+
+
+def _overlay(base, changes):
+    '''
+    A read-only view of base with changes laid over it, which leaves base as
+    it was. Once the changes add up to a good part of base, they're folded
+    into a fresh copy of it
+    '''
+    if isinstance(base, ChainMap):
+        layers, bottom = [changes] + base.maps[:-1], base.maps[-1]
+    else:
+        layers, bottom = [changes], base
+
+    if len(layers) > MAX_LAYERS:
+        merged = {}
+        for layer in reversed(layers):
+            merged.update(layer)
+        layers = [merged]
+    if isinstance(bottom, dict) and sum(len(layer) for layer in layers) > len(bottom) // 4:
+        bottom = dict(bottom)
+        for layer in reversed(layers):
+            bottom.update(layer)
+        return bottom
+    return ChainMap(*layers, bottom)
+
+
+def _add_counts(d, counts):
+    '''
+    New Successors for each word in counts ({word: {successor: count}}), with
+    the counts added on to whatever the word already had in d
+    '''
+    changes = {}
+    for word, following in counts.items():
+        options = successors(d, word)
+        combined = {option: options.weight(i) for i, option in enumerate(options.words)}
+        for option, count in following.items():
+            combined[option] = combined.get(option, 0) + count
+        changes[word] = Successors.from_counts(combined)
+    return changes
+
+
+def extend_models(models, text):
+    '''
+    Return new Models with more text added to the source, split into chunks
+    at paragraph breaks like get_file. The old Models aren't changed, so
+    anything still generating from them carries on as if nothing happened.
+
+    Only the words in the new text are touched: their Successors are rebuilt
+    with the new counts and laid over the old dictionaries, and so are the
+    rhyme sounds that gained words. The lexicon is shared and just grows.
+    '''
+    lexicon = models.lexicon
+    builder = ModelBuilder(lexicon)
+    for chunk in text.split('\n\n'):
+        builder.feed_chunk(chunk)
+
+    d_changes = _add_counts(models.d, builder.counts)
+    rev_d_changes = _add_counts(models.rev_d, builder.reverse_counts)
+    d = _overlay(models.d, d_changes)
+    rev_d = _overlay(models.rev_d, rev_d_changes)
+
+    seeds_changes = {}
+    # in the order the words turned up rather than a set's, so the seeds come
+    # out the same in every process
+    for rf in dict.fromkeys(lexicon.rhyme(word) for word in builder.new_words):
+        if rf is not None and len(lexicon.rhymes[rf]) >= 2:
+            seeds_changes[rf] = list(lexicon.rhymes[rf])
+    seeds = _overlay(models.seeds, seeds_changes) if seeds_changes else models.seeds
+
+    return models._replace(d=d, rev_d=rev_d, seeds=seeds,
+                           index=models.index.extended(d, d_changes),
+                           rev_index=models.rev_index.extended(rev_d, rev_d_changes))
+
+
+def _read_from(filepath, offset):
+    '''
+    The whole lines in a file from offset on, and the offset just past them.
+    A line that's still being written is left for next time
+    '''
+    with open(filepath, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    return data[:end].decode(locale.getpreferredencoding(False)), offset + end
+
+
+def _read_tail(filepath, offset):
+    with open(filepath, 'rb') as f:
+        start = max(offset - TAIL_SIZE, 0)
+        f.seek(start)
+        return f.read(offset - start)
+
+
+class DataFolderWatcher:
+    '''
+    Keeps a PoemMaker in step with its data folder by checking it every
+    interval seconds in a background thread. New sources are built and
+    served, deleted ones are dropped, and a text file that's only been added
+    to just has the new text fed into its models. Any other change to a
+    source rebuilds it.
+
+    Call poll() to check once without the thread.
+    '''
+    def __init__(self, poem_maker, interval=5.0):
+        self.poem_maker = poem_maker
+        self.interval = interval
+        # {source: (path, {file: (size, mtime)})} as of the last check
+        self.seen = {}
+        # {file: (offset read up to, bytes just before it)} for single file
+        # sources
+        self.read_to = {}
+        self._stop = threading.Event()
+        self._thread = None
+        for name, path in self.scan().items():
+            self.seen[name] = path
+            self._remember(name, *path)
+
+    def scan(self):
+        '''
+        {source: (path, {file: (size, mtime)})} for what's in the data folder
+        now
+        '''
+        sources = {}
+        folder = self.poem_maker.data_folder
+        for filename in os.listdir(folder):
+            if filename.startswith('.'):
+                continue
+            path = os.path.join(folder, filename)
+            try:
+                files = {}
+                for filepath in source_files(path):
+                    stat = os.stat(filepath)
+                    files[filepath] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                # deleted while we were looking. it'll be gone next time
+                continue
+            sources[source_name(filename)] = (path, files)
+        return sources
+
+    def _remember(self, name, path, files):
+        if not os.path.isdir(path) and path in files:
+            size = files[path][0]
+            self.read_to[path] = (size, _read_tail(path, size))
+
+    def _appended(self, path, files):
+        '''
+        The text added to the end of a single file source since we last read
+        it, or None if it's been changed some other way
+        '''
+        if os.path.isdir(path) or path not in self.read_to:
+            return None
+        offset, tail = self.read_to[path]
+        if files[path][0] < offset or _read_tail(path, offset) != tail:
+            return None
+        text, end = _read_from(path, offset)
+        self.read_to[path] = (end, _read_tail(path, end))
+        return text
+
+    def poll(self):
+        '''
+        Bring the PoemMaker up to date with the data folder
+        '''
+        current = self.scan()
+        for name in self.seen.keys() - current.keys():
+            logging.info('Source %s was removed', name)
+            self.poem_maker.remove_source(name, self.seen[name][0])
+            self.read_to.pop(self.seen[name][0], None)
+
+        for name, (path, files) in current.items():
+            if name in self.seen and self.seen[name] == (path, files):
+                continue
+            try:
+                text = self._appended(path, files) if name in self.seen else None
+                if text is not None:
+                    logging.info('Adding %d new characters to %s', len(text), name)
+                    # a source that isn't loaded reads the new text from
+                    # its file whenever it is
+                    if text.strip():
+                        self.poem_maker.append_text(name, text, if_loaded=True)
+                else:
+                    logging.info('Building source %s', name)
+                    self.poem_maker.add_source(name, path)
+                    self._remember(name, path, files)
+            except Exception:
+                # try again next time round
+                logging.exception('Failed to update source %s', name)
+                continue
+            self.seen[name] = (path, files)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name='data-folder-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logging.exception('Failed to check the data folder')
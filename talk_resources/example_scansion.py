@@ -5,7 +5,8 @@ import random
 pm = PoemMaker()
 pm.setup()
 
-d, rev_d, seeds = pm.text_sources['poem']
+models = pm.text_sources['poem']
+d = models.d
 
 def valid(words, desired_meter):
     fps = ''.join([syllable_fingerprint(word) for word in words])